@@ -48,7 +48,10 @@ def detect_udc(conf):
     status.error("Unable to autodetect UDC controller. No controllers found.")
     return
 
-  conf.udc_controller = dirnames[0]
+  if conf.parallel > len(dirnames):
+    status.warn(f"--parallel {conf.parallel} requested, but only {len(dirnames)} UDC controllers found.")
+
+  conf.udc_controller = ",".join(dirnames[:max(1, conf.parallel)])
   status.info(f"Auto-selected UDC controller {conf.udc_controller}")
 
   if "dummy" in conf.udc_controller:
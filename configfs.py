@@ -1,6 +1,19 @@
 import status
 import os
 import glob
+import threading
+import time
+
+import heur.udc.state
+
+# Held while picking and creating a new gadget directory,
+# since several gadgets may be set up at once (see scheduler.py)
+_CREATE_LOCK = threading.Lock()
+
+# --udc-controller may name several controllers, separated by commas
+def udc_controllers(conf):
+  if not conf.udc_controller: return []
+  return [ u.strip() for u in conf.udc_controller.split(",") if u.strip() ]
 
 def _globlinks(pattern):
   ret = glob.glob(pattern)
@@ -41,13 +54,36 @@ def _putstr(conf, root, subpath, contents):
   contents = contents + "\n"
   return _putbytes(conf, root, subpath, contents.encode())
 
-# Recursively apply a set of properties to the configfs,
-# by creating directories and writing to files.
+#
+# Gadget build plans
+#
+# A device spec is compiled into a flat list of operations on the gadget directory:
+#   ("mkdir", subpath)              Create a directory, unless the kernel already did
+#   ("write", subpath, data)        Write bytes to an attribute
+#   ("symlink", target, subpath)    Link subpath to target
+# All paths are relative to the gadget directory.
+# Attaching the gadget to the UDC is not part of the plan.
+#
+# Functions, configs and os_desc come first. Those are usually inherited as-is
+# from a template, so that part of the plan is compiled once and shared by every
+# device based on the same template. The device's own properties and strings follow.
+#
+
+# (functions, configs, os_desc, language code) -> (spec parts, ops, warnings)
+# The spec parts are kept to make sure their ids aren't reused.
+PLAN_CACHE = {}
+
+def _encode(val):
+  if type(val) in [ list, tuple ]:
+    return bytes(val)
+  return (str(val) + "\n").encode()
+
+# Compile a set of properties, by creating directories and writing to files.
 # If any value is a list of integers, the corresponding byte blob will be written to file.
-# If any write or mkdir fails, we bail out and report it.
-def _put_properties(conf, root, tree):
-  props = { name: val for name,val in tree.items() if type(val) in [ str, int, float, bool, list ]}
-  subdirs = { name: val for name,val in tree.items() if type(val) == dict}
+# If anything is malformed, we bail out and report it.
+def _compile_properties(root, tree, ops):
+  props = { name: val for name,val in tree.items() if type(val) in [ str, int, float, bool, list, tuple ]}
+  subdirs = { name: val for name,val in tree.items() if isinstance(val, dict)}
 
   for name,val in tree.items():
     if name not in props and name not in subdirs:
@@ -57,31 +93,186 @@ def _put_properties(conf, root, tree):
     if "/" in key:
       return False,f"Invalid key {key} in properties of {root}."
 
-    if type(val) is list:
-      try:
-        data = bytes(val)
-        ok,msg = _putbytes(conf, root, key, data)
-      except Exception as e:
-        return False,(f"Failed to interpret byte blob {key} at {root}: " + str(e))
-    else:
-      ok,msg = _putstr(conf, root, key, val)
-
-    if not ok:
-      return False,(f"Failed to set configuration property {key} at {root}: " + msg)
+    try:
+      ops.append(("write", os.path.join(root, key), _encode(val)))
+    except Exception as e:
+      return False,(f"Failed to interpret byte blob {key} at {root}: " + str(e))
 
   # Recurse down the tree of properties
   for key,sub_tree in subdirs.items():
     if "/" in key:
       return False,f"Invalid subdir {key} in properties of {root}."
 
-    sub_root = f"{root}/{key}"
-    ok,msg = _put_properties(conf, sub_root, sub_tree)
+    sub_root = os.path.join(root, key)
+    ops.append(("mkdir", sub_root))
+    ok,msg = _compile_properties(sub_root, sub_tree, ops)
     if not ok:
       return False,(f"Failed to set up configuration tree {key} at {root}: " + msg)
 
   return True,""
 
 
+def _compile_strings(root, strings, lang, ops):
+  ops.append(("mkdir", f"{root}strings/{lang}"))
+  for key,val in strings.items():
+    assert("/" not in key)
+    ops.append(("write", f"{root}strings/{lang}/{key}", _encode(val)))
+
+
+# Functions, configs and os_desc of a device
+def _compile_structure(conf, dev):
+  ops = []
+  warnings = []
+
+  # Defined functions of the device
+  for fname,fspec in dev.get("functions", {}).items():
+    assert("/" not in fname)
+
+    fpath = f"functions/{fname}"
+    ops.append(("mkdir", fpath))
+
+    if "properties" in fspec:
+      ok,msg = _compile_properties(fpath, fspec["properties"], ops)
+      if not ok:
+        warnings.append(f"Failed to configure function {fname}: " + msg)
+
+  for cname, cspec in dev.get("configs", {}).items():
+    assert("/" not in cname)
+    cpath = f"configs/{cname}"
+    ops.append(("mkdir", cpath))
+
+    if "properties" in cspec:
+      ok,msg = _compile_properties(cpath, cspec["properties"], ops)
+      if not ok:
+        warnings.append(f"Failed to configure configuration {cname}: " + msg)
+
+    if "strings" in cspec:
+      _compile_strings(cpath + "/", cspec["strings"], conf.language_code, ops)
+
+    for func in cspec.get("functions", []):
+      if func not in dev.get("functions", {}):
+        warnings.append(f"Configuration {cname} uses undefined function {func}. Ignoring.")
+        continue
+
+      ops.append(("symlink", f"functions/{func}", f"{cpath}/{func}"))
+
+  if "os_desc" in dev:
+    osd = dev["os_desc"]
+
+    for cname in osd.get("configs", []):
+      assert("/" not in cname)
+      if cname not in dev.get("configs", {}):
+        warnings.append(f"os_desc references undefined config {cname}. Ignoring.")
+        continue
+
+      ops.append(("symlink", f"configs/{cname}", f"os_desc/{cname}"))
+
+    if "properties" in osd:
+      ok,msg = _compile_properties("os_desc", osd["properties"], ops)
+      if not ok:
+        warnings.append(f"Failed to configure os_desc: " + msg)
+
+  return ops,warnings
+
+
+# Properties and strings of the device itself
+def _compile_identity(conf, dev):
+  ops = []
+  warnings = []
+
+  # Basic properties of the USB device
+  if "properties" in dev:
+    ok,msg = _compile_properties("", dev["properties"], ops)
+    if not ok:
+      warnings.append(f"Failed to set property. Probably not supported by the kernel. Outdated device database? " + msg)
+
+  # Device strings
+  if "strings" in dev:
+    _compile_strings("", dev["strings"], conf.language_code, ops)
+
+  return ops,warnings
+
+
+# Returns the build plan of a device, as (ops, warnings)
+def compile_gadget(conf, dev):
+  parts = (dev.get("functions"), dev.get("configs"), dev.get("os_desc"))
+  key = tuple(id(p) for p in parts) + (conf.language_code,)
+
+  if key not in PLAN_CACHE:
+    ops,warnings = _compile_structure(conf, dev)
+    PLAN_CACHE[key] = (parts, tuple(ops), tuple(warnings))
+  _,prefix_ops,prefix_warnings = PLAN_CACHE[key]
+
+  ops,warnings = _compile_identity(conf, dev)
+  return prefix_ops + tuple(ops), list(prefix_warnings) + warnings
+
+
+# Human-readable listing of a plan, for --dry-run
+def format_plan(ops, root="$GADGET"):
+  lines = []
+  for op in ops:
+    if op[0] == "mkdir":
+      lines.append(f"mkdir    {root}/{op[1]}")
+    elif op[0] == "write":
+      lines.append(f"write    {root}/{op[1]} = {op[2]!r}")
+    elif op[0] == "symlink":
+      lines.append(f"symlink  {root}/{op[2]} -> {root}/{op[1]}")
+  return lines
+
+
+# Carry out a build plan in the given gadget directory.
+# Failing writes are reported as warnings, since the kernel may not support
+# every attribute. Failing to create directories or links is fatal.
+# Returns ok,msg,timings where timings is a list of (op, seconds)
+def apply_plan(conf, root, ops):
+  timings = []
+
+  for op in ops:
+    t0 = time.perf_counter()
+    kind = op[0]
+
+    if kind == "write":
+      path = os.path.join(root, op[1])
+      try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+          os.write(fd, op[2])
+        finally:
+          os.close(fd)
+        if conf.debug:
+          readback = open(path, "rb").read().strip()
+          status.debug(f"After writing {op[2]} to {path}, value is {readback}")
+      except OSError as e:
+        status.warn(f"Failed to set configuration property {path}: " + str(e))
+
+    elif kind == "mkdir":
+      try:
+        os.mkdir(os.path.join(root, op[1]))
+      except FileExistsError:
+        pass
+      except OSError as e:
+        return False,f"Failed to create {op[1]}: " + str(e),timings
+
+    elif kind == "symlink":
+      try:
+        os.symlink(os.path.join(root, op[1]), os.path.join(root, op[2]))
+      except OSError as e:
+        return False,f"Failed to link {op[2]} to {op[1]}: " + str(e),timings
+
+    timings.append((op, time.perf_counter() - t0))
+
+  return True,"",timings
+
+
+def _report_timings(conf, path, timings):
+  if not conf.debug: return
+
+  total = sum(t for _,t in timings)
+  status.debug(f"Built {path} in {len(timings)} operations, {total*1000:.1f} ms")
+  for op,t in sorted(timings, key=lambda x: -x[1])[:5]:
+    status.debug(f"   {t*1000:7.2f} ms  {op[0]} {op[-1] if op[0] == 'symlink' else op[1]}")
+
+
 # Generate a new, currently unused, configfs gadget directory
 def select_gadget_path(conf):
   conf_root = os.path.join(conf.configfs, "usb_gadget")
@@ -108,110 +299,265 @@ def list_gadgets(conf, list_all=False):
     return list(glob.glob(os.path.join(conf_root, "*")))
 
 
-# Create a configfs directory and set up a device based on the provided spec
+# Create a configfs directory and set up a device based on the provided spec,
+# without attaching it to a UDC.
 # returns the name of the created directory
-def create_gadget(conf, dev):
-  path,msg = select_gadget_path(conf)
+def stage_gadget(conf, dev):
+  with _CREATE_LOCK:
+    path,msg = select_gadget_path(conf)
+    if path is None:
+      return None,msg
+
+    try:
+      os.mkdir(path)
+    except Exception as e:
+      return None, (f"Failed to create gadget {path}: " + str(e))
+
+  ops,warnings = compile_gadget(conf, dev)
+  for w in warnings:
+    status.warn(f"Device {dev['name']}: " + w)
+
+  ok,msg,timings = apply_plan(conf, path, ops)
+  _report_timings(conf, path, timings)
+  if not ok:
+    delete_gadget(conf, path)
+    return None,msg
+
+  return path,""
+
+
+# Create a configfs directory and set up a device based on the provided spec.
+# The gadget is attached to the given UDC, or the first --udc-controller.
+# returns the name of the created directory
+def create_gadget(conf, dev, udc=None):
+  if udc is None:
+    udc = udc_controllers(conf)[0]
+
+  path,msg = stage_gadget(conf, dev)
   if path is None:
     return None,msg
 
-  try:
-    os.mkdir(path)
-  except Exception as e:
-    return None, (f"Failed to create gadget {path}: " + str(e))
+  # Finally, connect the device to the host!
+  ok,msg = bind_gadget(conf, path, udc)
+  if not ok:
+    delete_gadget(conf, path)
+    return None,msg
 
 
-  # Basic properties of the USB device
-  if "properties" in dev:
-    ok,msg = _put_properties(conf, path, dev["properties"])
-    if not ok:
-      status.warn(f"Failed to set property of {dev['name']}. Probably not supported by the kernel. Outdated device database? " + msg)
+  return path,""
 
-  #if conf.debug: input("RETURN to continue")
 
+# Attach a gadget to a UDC, or detach it with udc=""
+def bind_gadget(conf, path, udc):
+  return _putstr(conf, path, "UDC", udc)
 
-  # Device strings
-  if "strings" in dev:
-    os.mkdir(f"{path}/strings/{conf.language_code}")
-    for key,val in dev["strings"].items():
-      assert("/" not in key)
-      ok,msg = _putstr(conf, path, f"strings/{conf.language_code}/{key}", val)
-      if not ok:
-        status.warn(f"Failed to set string {key} of {dev['name']}: " + msg)
 
+# True if the new device can be set up by rewriting the top-level properties
+# and strings of a live gadget of the old device. Everything else has to match,
+# and every property or string of the old device has to be overwritten,
+# since configfs attributes can't be unset.
+def can_reuse_gadget(conf, old, new):
+  if old.get("template") != new.get("template"): return False
 
-  #if conf.debug: input("RETURN to continue")
+  ignored = [ "name", "template", "metadata", "properties", "strings" ]
+  for key in set(old.keys()) | set(new.keys()):
+    if key in ignored: continue
+    if old.get(key) != new.get(key): return False
 
-  # Defined functions of the device
-  if "functions" in dev:
-    for fname,fspec in dev["functions"].items():
-      assert("/" not in fname)
+  for key in [ "properties", "strings" ]:
+    if not set(old.get(key, {}).keys()) <= set(new.get(key, {}).keys()):
+      return False
 
-      fpath = f"{path}/functions/{fname}"
-      os.mkdir(fpath)
+  return True
 
-      if "properties" in fspec:
-        ok,msg = _put_properties(conf, fpath, fspec["properties"])
-        if not ok:
-          status.warn(f"Failed to configure function {fname} of {dev['name']}: " + msg)
 
-  #if conf.debug: input("RETURN to continue")
+# Turn a live gadget of the old device into the new device,
+# writing only the properties and strings that differ.
+# Functions, configs and their kernel devices (network interfaces, ttys)
+# stay in place. If given, before_bind(conf, new, path) is called
+# just before the updated gadget is attached to the host again.
+def update_gadget(conf, path, old, new, udc, before_bind=None):
+  ok,msg = bind_gadget(conf, path, "")
+  if not ok:
+    return False,"Failed to unbind gadget: " + msg
+
+  # Both devices share their structure, so only the identity part of the plan differs
+  old_ops,_ = _compile_identity(conf, old)
+  new_ops,warnings = _compile_identity(conf, new)
+  for w in warnings:
+    status.warn(f"Device {new['name']}: " + w)
+
+  old_ops = set(old_ops)
+  changed = [ op for op in new_ops if op not in old_ops ]
+  ok,msg,timings = apply_plan(conf, path, changed)
+  _report_timings(conf, path, timings)
+  if not ok:
+    return False,msg
 
-  if "configs" in dev:
-    for cname, cspec in dev["configs"].items():
-      assert("/" not in cname)
-      cpath = f"{path}/configs/{cname}"
-      os.mkdir(cpath)
-
-      if "properties" in cspec:
-        ok,msg = _put_properties(conf, cpath, cspec["properties"])
-        if not ok:
-          status.warn(f"Failed to configure configuration {cname} of {dev['name']}: " + msg)
-
-      if "strings" in cspec:
-        os.mkdir(f"{cpath}/strings/{conf.language_code}")
-        for key,val in cspec["strings"].items():
-          assert("/" not in key)
-          ok,msg = _putstr(conf, cpath, f"strings/{conf.language_code}/{key}", val)
-          if not ok:
-            status.warn(f"Failed to set configuration string {key} of {dev['name']} configuration {cname}: " + msg)
-
-      if "functions" in cspec:
-        for func in cspec["functions"]:
-          if func not in dev["functions"].keys():
-            status.warn("Device {dev['name']} configuration {cname} uses undefined function {func}. Ignoring.")
-            continue
-
-          os.symlink(f"{path}/functions/{func}", f"{cpath}/{func}")
+  if before_bind is not None:
+    before_bind(conf, new, path)
 
-  # Defined functions of the device
-  if "os_desc" in dev:
-    osd = dev["os_desc"]
-    spath = f"{path}/os_desc"
+  ok,msg = bind_gadget(conf, path, udc)
+  if not ok:
+    return False,"Failed to bind gadget: " + msg
 
-    if "configs" in osd:
-      for cname in osd["configs"]:
-        assert("/" not in cname)
-        if cname not in dev["configs"]:
-          status.warn("os_desc of {dev['name']} references undefined config {cname}. Ignoring.")
-          continue
+  return True,""
 
-        os.symlink(f"{path}/configs/{cname}", f"{spath}/{cname}")
 
-    if "properties" in osd:
-      ok,msg = _put_properties(conf, spath, osd["properties"])
+# A UDC, and the gadget currently attached to it.
+#
+# With --reuse-gadget, the gadget is kept after testing, and if the next device
+# only differs from it by top-level properties and strings, it is updated
+# in place instead of being torn down and created again.
+# on_reuse is passed to update_gadget() as before_bind.
+#
+# With --pipeline, the device passed to prepare() is built in the background
+# while the current one is under test. Switching to it then only takes
+# a write to the UDC, and the old gadget is torn down in the background.
+class GadgetSlot:
+  def __init__(self, conf, udc=None, on_reuse=None):
+    self.conf = conf
+    self.udc = udc if udc is not None else udc_controllers(conf)[0]
+    self.on_reuse = on_reuse
+    self.path = None
+    self.dev = None
+
+    # True if the last attach() updated a live gadget
+    self.reused = False
+
+    # Device to build once the current one is attached, and the build in progress.
+    self.upcoming = None
+    self.staged = None
+
+    # Background deletions of gadgets we're done with
+    self.teardowns = []
+
+    # time.monotonic() at the start of the last attach(). Anything the host
+    # does to the attached device comes after it.
+    self.attached = None
+
+    # Follow the UDC state from the start, so that no transition of a device is missed
+    heur.udc.state.watch(self.udc)
+
+  # Tell the slot which device comes after the one being attached
+  def prepare(self, dev):
+    self.upcoming = dev
+
+  def attach(self, dev):
+    self.reused = False
+    self.attached = time.monotonic()
+
+    if self.path is not None:
+      if self.conf.reuse_gadget and can_reuse_gadget(self.conf, self.dev, dev):
+        ok,msg = update_gadget(self.conf, self.path, self.dev, dev, self.udc, self.on_reuse)
+        if ok:
+          self.dev = dev
+          self.reused = True
+          self._stage_upcoming()
+          return self.path,""
+        status.debug(f"Unable to reuse gadget {self.path} for {dev['name']}, creating a new one: " + msg)
+
+    staged_path = self._take_staged(dev)
+    if staged_path is not None:
+      # Only one gadget can be attached to the UDC at a time
+      if self.path is not None:
+        bind_gadget(self.conf, self.path, "")
+      self._teardown_async()
+
+      ok,msg = bind_gadget(self.conf, staged_path, self.udc)
       if not ok:
-        status.warn(f"Failed to configure os_desc of {dev['name']}: " + msg)
+        delete_gadget(self.conf, staged_path)
+        return None,msg
 
+      self.path = staged_path
+      self.dev = dev
+      self._stage_upcoming()
+      return staged_path,""
 
-  # Finally, connect the device to the host!
-  ok,msg = _putstr(conf, path, "UDC", conf.udc_controller)
-  if not ok:
-    delete_gadget(conf, path)
-    return None,msg
+    self.release()
 
+    path,msg = create_gadget(self.conf, dev, self.udc)
+    if path is None:
+      return None,msg
 
-  return path,""
+    self.path = path
+    self.dev = dev
+    self._stage_upcoming()
+    return path,""
+
+  # Called when testing of the current device is done
+  def detach(self):
+    # A pipelined gadget is detached when the next one is attached
+    if not self.conf.reuse_gadget and not self.conf.pipeline:
+      self.release()
+
+  def release(self):
+    if self.staged is not None:
+      self._take_staged(None)
+
+    for t in self.teardowns:
+      t.join()
+    self.teardowns = []
+
+    if self.path is None: return
+
+    ok,msg = delete_gadget(self.conf, self.path)
+    if not ok:
+      status.error(f"Failed to delete gadget {self.path}: " + msg)
+    self.path = None
+    self.dev = None
+
+  # Start building the upcoming device in the background, unless it can reuse the current gadget
+  def _stage_upcoming(self):
+    dev = self.upcoming
+    self.upcoming = None
+
+    if not self.conf.pipeline or dev is None: return
+    if self.conf.reuse_gadget and can_reuse_gadget(self.conf, self.dev, dev): return
+
+    result = {}
+    def build():
+      result["path"],result["msg"] = stage_gadget(self.conf, dev)
+
+    thread = threading.Thread(target=build, daemon=True)
+    thread.start()
+    self.staged = (dev, thread, result)
+
+  # Wait for the staged gadget, and return its path if it was built for dev.
+  # Any other staged gadget is deleted.
+  def _take_staged(self, dev):
+    if self.staged is None: return None
+
+    staged_dev,thread,result = self.staged
+    self.staged = None
+    thread.join()
+
+    path = result.get("path")
+    if path is None:
+      status.debug(f"Pre-staging {staged_dev['name']} failed: " + result.get("msg", ""))
+      return None
+
+    if staged_dev is not dev:
+      delete_gadget(self.conf, path)
+      return None
+
+    return path
+
+  # Delete the current gadget in the background
+  def _teardown_async(self):
+    if self.path is None: return
+
+    path = self.path
+    def teardown():
+      ok,msg = delete_gadget(self.conf, path)
+      if not ok:
+        status.error(f"Failed to delete gadget {path}: " + msg)
+
+    thread = threading.Thread(target=teardown, daemon=True)
+    thread.start()
+    self.teardowns = [ t for t in self.teardowns if t.is_alive() ] + [ thread ]
+    self.path = None
+    self.dev = None
 
 
 def delete_gadget(conf, path):
@@ -223,7 +569,7 @@ def delete_gadget(conf, path):
 
 
   # Disconnect the USB device from the host
-  _putstr(conf, path, "UDC", "")
+  bind_gadget(conf, path, "")
 
   # Detach all functions from each config
   for l in _globlinks(f"{path}/configs/*/*"):
@@ -1,35 +1,380 @@
 import json5
+import json
+import hashlib
 import os
-import copy
-import pathlib
+import array
+import bisect
+import fnmatch
+import collections.abc
 
 import status
 
 # Cached copy of the loaded device database
 DEVICE_DB=None
 
+# Parsed device files, persisted to --device-cache between runs.
+# Parsing JSON5 is by far the slowest part of loading the database,
+# so we keep the parsed (but not template-resolved) contents of each file
+# as plain JSON, keyed on the file's absolute path.
+# An entry is valid as long as the file's mtime and size are unchanged,
+# or failing that, if the contents still hash to the same value.
+DEVICE_CACHE=None
+DEVICE_CACHE_DIRTY=False
+DEVICE_CACHE_VERSION=1
+
+# Paths of the device files read while loading the database, see _prune_cache()
+DEVICE_CACHE_SEEN=set()
+
+
+# Device specs are shared between everyone who loads the database,
+# and between devices using the same template. To keep that safe,
+# they are handed out read-only. Use copy_device() to get a private,
+# mutable copy of a single device.
+class ReadOnlyDict(dict):
+  def _readonly(self, *args, **kwargs):
+    raise TypeError("Device specs are read-only. Use devicespec.copy_device() to modify one.")
+
+  __setitem__ = _readonly
+  __delitem__ = _readonly
+  __ior__ = _readonly
+  clear = _readonly
+  pop = _readonly
+  popitem = _readonly
+  setdefault = _readonly
+  update = _readonly
+
+  # Immutable, so there's never a reason to duplicate it
+  def __copy__(self):
+    return self
+
+  def __deepcopy__(self, memo):
+    return self
+
+
+# The auto-generated device files hold thousands of devices which only differ
+# from their template by idVendor and idProduct. Rather than resolving each of
+# them to a complete spec, they are kept as a shared template and packed arrays
+# of IDs. The complete spec is built whenever someone actually looks up the device.
+class _CompactGroup:
+  def __init__(self, template, source):
+    self.template = template
+    self.source = source
+    self.names = []
+    self.vids = array.array("H")
+    self.pids = array.array("H")
+
+  def add(self, name, vid, pid):
+    self.names.append(name)
+    self.vids.append(vid)
+    self.pids.append(pid)
+    return len(self.names) - 1
+
+  def build(self, i):
+    return _build_from_ids(self.template, self.names[i], self.vids[i], self.pids[i], self.source)
+
+
+# Complete spec of a device which only differs from its template by idVendor and idProduct
+def _build_from_ids(template, name, vid, pid, source):
+  dev = {
+    "name": name,
+    "template": template["name"],
+    "properties": { "idVendor": vid, "idProduct": pid },
+    "metadata": { "source": source },
+  }
+  res,_ = _merge_dicts(template, dev)
+  return _freeze(res)
+
+
+# A range selector, template@VID:PID, describes every combination of
+# the given vendor and product IDs applied to one template.
+# Each of VID and PID is a hex number or an inclusive range, e.g.
+#    ecm-2.0@0x0bda:0x0000-0xffff
+# The devices are never stored anywhere, they are generated when needed.
+# Each generated device is named like a range selector of a single device,
+# so that it can be passed back on the command line.
+class DeviceRange:
+  def __init__(self, selector, template, vids, pids):
+    self.selector = selector
+    self.template = template
+    self.vids = vids
+    self.pids = pids
+
+  def __len__(self):
+    return len(self.vids) * len(self.pids)
+
+  def ids(self, i):
+    return self.vids[i // len(self.pids)], self.pids[i % len(self.pids)]
+
+  def name(self, i):
+    vid,pid = self.ids(i)
+    return f"{self.template}@{vid:#06x}:{pid:#06x}"
+
+
+def _parse_id_range(text):
+  lo,_,hi = text.partition("-")
+  lo = int(lo, 16)
+  hi = int(hi, 16) if hi else lo
+  if lo < 0 or hi > 0xffff or lo > hi:
+    raise ValueError(f"Invalid USB ID range {text}")
+  return range(lo, hi+1)
+
+
+# Returns a DeviceRange, or None if the text isn't a range selector
+def parse_device_range(selector):
+  template,at,ids = selector.rpartition("@")
+  if not at or not template: return None
+
+  vids,colon,pids = ids.partition(":")
+  if not colon: return None
+
+  try:
+    return DeviceRange(selector, template, _parse_id_range(vids), _parse_id_range(pids))
+  except ValueError:
+    return None
+
+
+# A read-only mapping of device name to device spec.
+# Entries are either complete specs, or (_CompactGroup, index) for compacted devices.
+class DeviceDB(collections.abc.Mapping):
+  def __init__(self, entries=None):
+    self._entries = {} if entries is None else dict(entries)
+    self._index = None
+
+  # Besides the devices in the database, this also looks up
+  # devices generated from a range selector of a single device.
+  # Those are never part of iteration or len().
+  def __getitem__(self, name):
+    if name not in self._entries:
+      return self._generate(name)
+
+    entry = self._entries[name]
+    if type(entry) is tuple:
+      group,i = entry
+      return group.build(i)
+    return entry
+
+  # True if the device is in the database itself, and not generated from a range selector.
+  # A device saved from a range keeps the range selector as its name.
+  def defines(self, name):
+    return name in self._entries
+
+  # Doesn't build the spec, see __getitem__()
+  def __contains__(self, name):
+    return name in self._entries or self._single_range(name) is not None
+
+  # The range selector of a single device from this database, or None
+  def _single_range(self, name):
+    rng = parse_device_range(name)
+    if rng is None or len(rng) != 1 or rng.template not in self._entries:
+      return None
+    return rng
+
+  def _generate(self, name):
+    rng = self._single_range(name)
+    if rng is None:
+      raise KeyError(name)
+
+    vid,pid = rng.ids(0)
+    return _build_from_ids(self[rng.template], rng.name(0), vid, pid, rng.selector)
+
+  def __iter__(self):
+    return iter(self._entries)
+
+  def __len__(self):
+    return len(self._entries)
+
+  def copy(self):
+    return DeviceDB(self._entries)
+
+  # The search index is built on first use.
+  # Don't modify the database after calling this.
+  def index(self):
+    if self._index is None:
+      self._index = _DeviceIndex(self)
+    return self._index
+
+  # Cheap lookups, which don't require building a complete spec
+  def device_type(self, name):
+    entry = self._entries[name]
+    if type(entry) is tuple:
+      return entry[0].template.get("type")
+    return entry.get("type")
+
+  # Returns (type, template, idVendor, idProduct) of a device. Missing values are None.
+  def describe(self, name):
+    entry = self._entries[name]
+    if type(entry) is tuple:
+      group,i = entry
+      return group.template.get("type"), group.template["name"], group.vids[i], group.pids[i]
+
+    props = entry.get("properties", {})
+    return entry.get("type"), entry.get("template"), props.get("idVendor"), props.get("idProduct")
+
+  def source(self, name):
+    entry = self._entries[name]
+    if type(entry) is tuple:
+      return entry[0].source
+    return entry["metadata"]["source"]
+
+  # Yields every explicitly defined device, and one device per compacted group.
+  # Anything that holds for these holds for the whole database.
+  def representatives(self):
+    seen = set()
+    for entry in self._entries.values():
+      if type(entry) is not tuple:
+        yield entry
+        continue
+
+      group,i = entry
+      if id(group) in seen: continue
+      seen.add(id(group))
+      yield group.build(i)
+
+
+# Lookup tables over a complete DeviceDB, for selecting devices by pattern.
+# Devices are referred to by their position in the database, so that results
+# can be returned in database order.
+class _DeviceIndex:
+  def __init__(self, db):
+    self.names = list(db.keys())
+    self.position = { n: i for i,n in enumerate(self.names) }
+    self.sorted_names = sorted(self.names)
+
+    self.by_key = { "type": {}, "template": {}, "vid": {}, "pid": {} }
+    for i,name in enumerate(self.names):
+      dtype,template,vid,pid = db.describe(name)
+      for key,val in [ ("type", dtype), ("template", template), ("vid", vid), ("pid", pid) ]:
+        if val is None: continue
+        self.by_key[key].setdefault(val, []).append(i)
+
+    self.templates = set(self.by_key["type"].get("template", []))
+
+  # Positions of all names matching a glob, in database order
+  def _glob(self, pattern):
+    if pattern in self.position:
+      return [ self.position[pattern] ]
+
+    # Only names sharing the literal prefix of the glob can match it
+    prefix = pattern
+    for c in "*?[":
+      prefix = prefix.split(c)[0]
+    if prefix == pattern:
+      return []
+
+    start = bisect.bisect_left(self.sorted_names, prefix)
+    ret = []
+    for name in self.sorted_names[start:]:
+      if not name.startswith(prefix): break
+      if fnmatch.fnmatchcase(name, pattern):
+        ret.append(self.position[name])
+    return sorted(ret)
+
+  # Positions of the devices matching a single pattern, in database order
+  def _match(self, pattern):
+    key,_,val = pattern.partition(":")
+
+    if key in [ "vid", "pid" ] and val:
+      try:
+        return self.by_key[key].get(int(val, 16), [])
+      except ValueError:
+        status.warn(f"Invalid USB ID in device pattern {pattern}. Expected a hexadecimal number.")
+        return []
+
+    if key in [ "type", "template" ] and val:
+      return self.by_key[key].get(val, [])
+
+    if key == "name" and val:
+      return self._glob(val)
+
+    # Plain patterns are globs on the device name, or an exact device type
+    matches = self._glob(pattern)
+    if pattern in self.by_key["type"]:
+      matches = sorted(set(matches) | set(self.by_key["type"][pattern]))
+    return matches
+
+  # Device names matching any of the patterns, without duplicates.
+  # Results are ordered by the first pattern they match, then by database order.
+  # Range selectors are passed through as they are, see DeviceRange.
+  def select(self, patterns):
+    seen = set()
+    ret = []
+    for p in patterns:
+      # Devices saved from a range keep its selector as their name
+      rng = None if p in self.position else parse_device_range(p)
+      if rng is not None:
+        if rng.template not in self.position:
+          status.warn(f"Unknown template {rng.template} in device range {p}. Ignoring.")
+        elif p not in seen:
+          seen.add(p)
+          ret.append(p)
+        continue
+
+      for i in self._match(p):
+        if i in seen or i in self.templates: continue
+        seen.add(i)
+        ret.append(self.names[i])
+    return ret
+
+
 def _merge_databases(dest_db, src_db):
-  for name,src_dev in src_db.items():
+  for name,entry in src_db._entries.items():
     if name in dest_db:
-      dst_dev = dest_db[name]
-      return None,f"Device name {name} is defined in both {src_dev['metadata']['source']} and {dst_dev['metadata']['source']}"
+      return None,f"Device name {name} is defined in both {src_db.source(name)} and {dest_db.source(name)}"
 
-    dest_db[name] = src_dev
+    dest_db._entries[name] = entry
 
   return dest_db,""
 
+
+# True if the device only sets a template, idVendor and idProduct
+def _is_compactable(parent_db, dev):
+  if not set(dev.keys()) <= { "name", "template", "properties" }: return False
+  if dev.get("template") not in parent_db: return False
+
+  props = dev.get("properties")
+  if type(props) is not dict: return False
+  if set(props.keys()) != { "idVendor", "idProduct" }: return False
+
+  for val in props.values():
+    if type(val) is not int: return False
+    if val < 0 or val > 0xffff: return False
+
+  return True
+
+
+# Recursively convert a parsed object to its read-only form.
+# Lists become tuples. Parts which are already read-only are shared, not copied.
+def _freeze(obj):
+  if type(obj) is ReadOnlyDict or type(obj) is tuple:
+    return obj
+  if isinstance(obj, dict):
+    return ReadOnlyDict({ k: _freeze(v) for k,v in obj.items() })
+  if isinstance(obj, list):
+    return tuple(_freeze(v) for v in obj)
+  return obj
+
+
+# Make a plain, mutable copy of a device spec (or any part of one)
+def copy_device(obj):
+  if isinstance(obj, dict):
+    return { k: copy_device(v) for k,v in obj.items() }
+  if isinstance(obj, (list, tuple)):
+    return [ copy_device(v) for v in obj ]
+  return obj
+
+
+# Values from a are shared with the result, not copied,
+# so a should be read-only (see _freeze())
 def _merge_dicts(a, b):
-  res = copy.deepcopy(a)
+  res = dict(a)
 
   for key,new_val in b.items():
     if key not in res:
       res[key] = new_val
-    elif type(res[key]) != type(new_val):
+    elif not isinstance(res[key], dict) or not isinstance(new_val, dict):
       # Override!
       res[key] = new_val
-    elif type(res[key]) != dict:
-      res[key] = new_val
-    elif type(res[key]) == dict:
+    else:
       merged,msg = _merge_dicts(res[key], new_val)
       if merged is None:
         return None, f"{key}." + msg
@@ -40,7 +385,7 @@ def _merge_dicts(a, b):
 
 # Fill a device spec in with template data, if it has a template specified
 def _apply_template(conf, parent_db, dev):
-  if "template" not in dev: return dev,""
+  if "template" not in dev: return _freeze(dev),""
 
   if dev["template"] not in parent_db:
     return None, f"Unable to resolve template name {dev['template']} for device {dev['name']}."
@@ -50,13 +395,101 @@ def _apply_template(conf, parent_db, dev):
   if res is None:
     return None,f"Failed to apply template {dev['template']} to device {dev['name']}: " + msg
 
-  return res,""
+  return _freeze(res),""
+
+
+def _load_cache(conf):
+  global DEVICE_CACHE
+  DEVICE_CACHE = { "version": DEVICE_CACHE_VERSION, "files": {} }
+
+  if not conf.device_cache: return
+  if not os.path.isfile(conf.device_cache): return
+
+  try:
+    cache = json.loads(open(conf.device_cache, "r").read())
+  except Exception as e:
+    status.warn(f"Ignoring unreadable device cache {conf.device_cache}: " + str(e))
+    return
+
+  if type(cache) is not dict or cache.get("version") != DEVICE_CACHE_VERSION:
+    status.info(f"Device cache {conf.device_cache} is from another version. Rebuilding it.")
+    return
+
+  DEVICE_CACHE = cache
+
+
+# Drop the entries of files which are gone, or which are no longer part of
+# the database that was just loaded from root, e.g. after renaming them.
+def _prune_cache(root):
+  global DEVICE_CACHE_DIRTY
+  if DEVICE_CACHE is None: return
+
+  root = os.path.abspath(root)
+  for key in list(DEVICE_CACHE["files"].keys()):
+    if key in DEVICE_CACHE_SEEN: continue
+    if os.path.isfile(key) and key != root and not key.startswith(os.path.join(root, "")): continue
+
+    del DEVICE_CACHE["files"][key]
+    DEVICE_CACHE_DIRTY = True
+
+
+def _save_cache(conf):
+  global DEVICE_CACHE_DIRTY
+  if not conf.device_cache: return
+
+  _prune_cache(conf.device_db)
+  if not DEVICE_CACHE_DIRTY: return
+
+  # Write to the side and move into place, so that a reboot halfway through
+  # doesn't leave a corrupt cache behind.
+  tmp = conf.device_cache + ".tmp"
+  try:
+    open(tmp, "w+").write(json.dumps(DEVICE_CACHE, separators=(",", ":")))
+    os.replace(tmp, conf.device_cache)
+    DEVICE_CACHE_DIRTY = False
+  except Exception as e:
+    status.warn(f"Failed to write device cache {conf.device_cache}: " + str(e))
+
+
+# Parse a JSON5 device file, or fetch its contents from the cache
+def _parse_device_file(conf, filepath):
+  global DEVICE_CACHE_DIRTY
+  if DEVICE_CACHE is None:
+    _load_cache(conf)
+
+  key = os.path.abspath(filepath)
+  entry = DEVICE_CACHE["files"].get(key)
+  DEVICE_CACHE_SEEN.add(key)
+
+  st = os.stat(filepath)
+  if entry is not None and entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+    return entry["devices"]
+
+  raw = open(filepath, "rb").read()
+  digest = hashlib.sha1(raw).hexdigest()
+
+  if entry is not None and entry["sha1"] == digest:
+    # Touched, but not changed
+    devlist = entry["devices"]
+  else:
+    status.debug(f"Parsing device file {filepath}")
+    devlist = json5.loads(raw.decode())
+
+  DEVICE_CACHE["files"][key] = {
+    "mtime_ns": st.st_mtime_ns,
+    "size": st.st_size,
+    "sha1": digest,
+    "devices": devlist,
+  }
+  DEVICE_CACHE_DIRTY = True
+
+  return devlist
 
 
 # Load a device file containing multiple device specs.
 def _load_device_file(conf, parent_db, filepath):
   try:
-    devlist = json5.loads(open(filepath, "r").read())
+    devlist = _parse_device_file(conf, filepath)
   except Exception as e:
     return None,f"Failed to load device file {filepath}: " + str(e)
 
@@ -70,23 +503,34 @@ def _load_device_file(conf, parent_db, filepath):
     if type(dev) is not dict:
       return None,f"Device in {filepath} is not an object. Device contents: {str(dev)}"
 
-  # Add some metadata to each device definition
-  for dev in devlist:
-    if "metadata" not in dev: dev["metadata"] = {}
-    dev["metadata"]["source"] = filepath
+  resolved = DeviceDB()
+  groups = {}
 
-  resolved = { }
   # Resolve templates as needed
   for dev in devlist:
 
     if dev['name'] in resolved:
       return None,f"Device file {filepath} contains multiple devices named {dev['name']}"
 
+    if _is_compactable(parent_db, dev):
+      tname = dev["template"]
+      if tname not in groups:
+        groups[tname] = _CompactGroup(parent_db[tname], filepath)
+      group = groups[tname]
+
+      props = dev["properties"]
+      resolved._entries[dev['name']] = (group, group.add(dev["name"], props["idVendor"], props["idProduct"]))
+      continue
+
+    # Add some metadata to each device definition.
+    # The parsed objects may be shared with the device cache, so don't modify them in place.
+    dev = dict(dev, metadata=dict(dev.get("metadata", {}), source=filepath))
+
     dev,msg = _apply_template(conf, parent_db, dev)
     if dev is None:
       return None,f"Failed to load device file {filepath}: " + msg
 
-    resolved[dev['name']] = dev
+    resolved._entries[dev['name']] = dev
 
   return resolved,""
 
@@ -100,8 +544,9 @@ def _is_dev_file(path):
 
 # Recursively load a device database directory
 def _load_devices_dir(conf, root, parent_db=None):
-  if parent_db is None: parent_db = {}
-  else: parent_db = copy.deepcopy(parent_db)
+  # The devices themselves are read-only, so a shallow copy is enough
+  if parent_db is None: parent_db = DeviceDB()
+  else: parent_db = parent_db.copy()
 
   #print(f"Loading dev dir {root}")
 
@@ -114,7 +559,7 @@ def _load_devices_dir(conf, root, parent_db=None):
   #print("dirs: " + str(subdirs))
   #print("files: " + str(subfiles))
 
-  this_db = {}
+  this_db = DeviceDB()
 
   for subfile in subfiles:
 
@@ -132,7 +577,7 @@ def _load_devices_dir(conf, root, parent_db=None):
   if parent_db is None:
     return None,f"While merging root {root} to parent: " + msg
 
-  ret_db = {}
+  ret_db = DeviceDB()
 
   for subdir in subdirs:
     sub_db,msg = _load_devices_dir(conf, subdir, parent_db)
@@ -165,7 +610,7 @@ def load_devices(conf):
     if os.path.isfile(conf.device_db):
       # Load a single file database,
       # probably output from an earlier test
-      db,msg = _load_device_file(conf, {}, conf.device_db)
+      db,msg = _load_device_file(conf, DeviceDB(), conf.device_db)
 
     elif os.path.isdir(conf.device_db):
       db,msg = _load_devices_dir(conf, conf.device_db)
@@ -177,11 +622,18 @@ def load_devices(conf):
       return None,msg
     DEVICE_DB = db
 
-  return copy.deepcopy(DEVICE_DB),""
+    _save_cache(conf)
+
+  return DEVICE_DB,""
 
 
-# Given some globs, expand to device names that are present in the device database
-# A glob either matches device names using wildcards, or it exactly matches a device type.
+# Given some patterns, expand to device names that are present in the device database.
+# A pattern either matches device names using wildcards, or it exactly matches a device type.
+# Patterns of the form key:value select on a single field, where key is one of
+#   name      Device name glob, e.g. name:ecm-*
+#   type      Device type, e.g. type:net
+#   template  Name of the device's template, e.g. template:ecm-2.0
+#   vid, pid  idVendor or idProduct in hex, e.g. vid:0x0bda
 def expand_device_list(conf, patterns):
   if type(patterns) == str: patterns = [patterns]
 
@@ -189,20 +641,47 @@ def expand_device_list(conf, patterns):
   if devices is None:
     return []
 
-  ret = []
-
-  all_dev_names = list(devices.keys())
-  all_devs = list(devices.values())
-  for p in patterns:
-    name_matches = [ n for n in all_dev_names if pathlib.PurePath(n).match(p) ]
-    ret += name_matches
-
-    type_matches = [ dev['name'] for dev in all_devs if dev['type'] == p ]
-    ret += type_matches
-
-  # Don't return template-only devices
-  ret = [ r for r in ret if devices[r]["type"] != "template" ]
-
-  return ret
-
-
+  return devices.index().select(patterns)
+
+
+# Number of devices described by a list of device names and range selectors
+def count_devices(conf, selectors):
+  total = 0
+  for sel in selectors:
+    rng = parse_device_range(sel)
+    total += 1 if rng is None else len(rng)
+  return total
+
+
+# Generate (index, name, spec) for each device in a list of device names and
+# range selectors, starting at the given index. Ranges are expanded lazily,
+# so this works the same for a single device and for a vendor's entire product ID space.
+# Unknown device names are skipped, but still counted.
+def iter_devices(conf, devices, selectors, start=0):
+  offset = 0
+  for sel in selectors:
+    rng = None if devices.defines(sel) else parse_device_range(sel)
+
+    if rng is None:
+      if offset >= start:
+        if sel in devices:
+          yield offset, sel, devices[sel]
+        else:
+          status.warn(f"Unknown device {sel}. Skipping.")
+      offset += 1
+      continue
+
+    if offset + len(rng) <= start:
+      offset += len(rng)
+      continue
+
+    if rng.template not in devices:
+      status.warn(f"Unknown template {rng.template} in device range {sel}. Skipping.")
+      offset += len(rng)
+      continue
+
+    template = devices[rng.template]
+    for i in range(max(0, start - offset), len(rng)):
+      vid,pid = rng.ids(i)
+      yield offset + i, rng.name(i), _build_from_ids(template, rng.name(i), vid, pid, sel)
+    offset += len(rng)
@@ -196,6 +196,13 @@ def update_state(state, log_text):
     elif log_entry["kind"] == "progress":
       state["progress"] = log_entry["percent"]
 
+    # Each status file segment starts with one of these, so nothing is lost
+    # when tail follows the file to a new segment
+    elif log_entry["kind"] == "snapshot":
+      state["progress"] = log_entry.get("percent", state["progress"])
+      state["found"] = log_entry.get("found", state["found"])
+      state["current_device"] = log_entry.get("current_device", state["current_device"])
+
     elif log_entry["kind"] == "found":
       nam = log_entry["device_name"]
       vid = log_entry["device_vid"]
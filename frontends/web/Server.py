@@ -9,6 +9,9 @@
 # (i.e. the USB device) periodically. The webapp is robust to this.
 
 import argparse
+import bisect
+import gzip
+import os
 import sys
 import json
 import hashlib
@@ -35,6 +38,63 @@ def serve_file():
   return redirect("/index.html")
 
 
+# Lines of the status file, starting from the first entry that may be
+# at or after the timestamp.
+#
+# MacDongler writes the status file in segments, with an index of where
+# entries are. With the index, only the segments from that timestamp on
+# are read. Without it, the whole status file is.
+def read_status_lines(path, timestamp):
+  start_segment,start_offset = None,0
+
+  try:
+    with open(path + ".index", "r") as f:
+      index = [ json.loads(l) for l in f if l.strip() ]
+
+    # The last indexed entry before the timestamp. Everything after it is read.
+    timestamps = [ entry["timestamp"] for entry in index ]
+    i = bisect.bisect_left(timestamps, timestamp) - 1
+    if i >= 0:
+      start_segment,start_offset = index[i]["segment"], index[i]["offset"]
+    elif len(index) > 0:
+      start_segment = index[0]["segment"]
+  except Exception:
+    pass
+
+  if start_segment is None:
+    try:
+      return open(path, "r").readlines()
+    except:
+      return []
+
+  # Rotated segments are <path>.<N> or <path>.<N>.gz. The highest N is the current <path>.
+  lines = []
+  n = start_segment
+  while True:
+    if os.path.exists(f"{path}.{n}"):
+      f = open(f"{path}.{n}", "rb")
+    elif os.path.exists(f"{path}.{n}.gz"):
+      f = gzip.open(f"{path}.{n}.gz", "rb")
+    else:
+      f = None
+
+    try:
+      if f is None:
+        f = open(path, "rb")
+      with f:
+        if n == start_segment:
+          f.seek(start_offset)
+        lines += [ l.decode() for l in f ]
+    except OSError:
+      pass
+
+    if not os.path.exists(f"{path}.{n}") and not os.path.exists(f"{path}.{n}.gz"):
+      break
+    n += 1
+
+  return lines
+
+
 # For the status file, serve whatever data is in the MacDongler status-file.
 # Optionally, allow the client to filter by timestamp, since the status-file
 # may grow -very- large over time.
@@ -48,11 +108,7 @@ def serve_log(timestamp):
   # Convert it to a good old proper JSON list, so we can handle it from JavaScript
   log_data = []
 
-  lines = []
-  try:
-    lines = open(STATUS_FILE_PATH, "r").readlines()
-  except:
-    pass
+  lines = read_status_lines(STATUS_FILE_PATH, timestamp)
 
   # Only return entries newer than the provided timestamp
   # In addition, give each object a handy hash, so we can avoid duplication
@@ -94,6 +94,22 @@ function handle_progress(msg) {
   set_progress(msg["current"], msg["target"], msg["percent"]);
 }
 
+// Written at the start of each status file segment, and now and then,
+// so the scan state is known without reading older segments
+function handle_snapshot(msg) {
+  if ("current" in msg) {
+    set_progress(msg["current"], msg["target"], msg["percent"]);
+  }
+  if ("current_device" in msg) {
+    mcd_device_current.innerHTML = `${msg["current_device"]}`
+  }
+}
+
+function handle_summary(msg) {
+  log_message(msg["timestamp"], "info",
+              `Tested ${msg["devices"]} devices, ${msg["devices_per_hour"]} devices per hour`)
+}
+
 function handle_current_device(msg) {
   mcd_device_current.innerHTML = `${msg["device_name"]}`
 }
@@ -162,6 +178,18 @@ function handle_event(msg) {
       handle_found_device(msg);
       break;
 
+    case "snapshot":
+      handle_snapshot(msg);
+      break;
+
+    // Per-device timing, for offline analysis
+    case "phases":
+      break;
+
+    case "summary":
+      handle_summary(msg);
+      break;
+
     default:
       console.log(`Unsupported message type: ${msg["kind"]}. Update the front-end.`)
   }
@@ -0,0 +1,145 @@
+#
+# The host-side view of a gadget under test: which network interface,
+# tty or hidg nodes the kernel created for it.
+#
+# A GadgetContext is created once the gadget is attached, and handed to
+# the heuristics and stimulation methods. Nodes are looked up on first use
+# and remembered, so everyone gets the same answer without walking configfs,
+# /dev and /sys again.
+#
+
+import glob
+import os
+import threading
+import time
+
+import heur.hid.util
+import heur.net.util
+import heur.serial.util
+import uevent
+
+
+class GadgetContext:
+  # created is the time.monotonic() the gadget was attached at, if known
+  def __init__(self, conf, dev, path, created=None):
+    self.conf = conf
+    self.dev = dev
+    self.path = path
+
+    # Anything the host did to the gadget before this doesn't count for it
+    self.created = created if created is not None else time.monotonic()
+
+    # Guards durations and phases, which heuristics running in the background add to
+    self.lock = threading.Lock()
+
+    # Seconds spent in each heuristic, see heuristics.test_device()
+    self.durations = {}
+
+    # Seconds spent in each phase of the test, see status.phases()
+    self.phases = {}
+
+    # What heuristics observed, by heuristic name. Saved with working devices.
+    self.evidence = {}
+
+    # Stimulation which keeps running during the test, see stimulation.cleanup_device()
+    self.stimulators = []
+
+    self._nodes = {}
+
+  def _resolve(self, kind, find):
+    if kind not in self._nodes:
+      node = find(self.conf, self.dev, self.path)
+
+      # Nodes may show up a while after the gadget is bound,
+      # so only remember the ones that were found.
+      if node is None:
+        return None
+      self._nodes[kind] = node
+
+    return self._nodes[kind]
+
+  def add_phase(self, phase, seconds):
+    with self.lock:
+      self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+  # A copy of the phases so far, safe to iterate
+  def phases_so_far(self):
+    with self.lock:
+      return dict(self.phases)
+
+  # Name of the UDC the gadget is bound to
+  @property
+  def udc(self):
+    return self._resolve("udc", _find_udc)
+
+  # Network interface name of a net device
+  @property
+  def iface(self):
+    if self.dev["type"] != "net": return None
+    return self._resolve("iface", heur.net.util.find_iface)
+
+  # /dev/ttyGS* node of a serial device
+  @property
+  def tty(self):
+    if self.dev["type"] != "serial": return None
+    return self._resolve("tty", heur.serial.util.find_tty)
+
+  # List of /dev/hidg* nodes of a HID device
+  @property
+  def hiddevs(self):
+    if self.dev["type"] != "hid": return None
+    return self._resolve("hiddevs", heur.hid.util.find_hiddev)
+
+  # True once the kernel has created every node this gadget is expected to have
+  def ready(self):
+    if self.dev["type"] == "net":
+      # Bound but unnamed interfaces aren't usable yet
+      iface = self.iface
+      return iface is not None and os.path.exists(f"/sys/class/net/{iface}")
+
+    if self.dev["type"] == "serial":
+      if self.conf.serial_device is not None:
+        return os.path.exists(self.conf.serial_device)
+      if glob.glob(f"{self.path}/functions/acm.*") + glob.glob(f"{self.path}/functions/gser.*"):
+        return heur.serial.util.find_configfs_tty(self.path) is not None
+      return len(glob.glob("/dev/ttyGS*")) > 0
+
+    if self.dev["type"] == "hid":
+      # Composite devices have several nodes, wait for all of them
+      hiddevs = heur.hid.util.find_hiddev(self.conf, self.dev, self.path)
+      if hiddevs is None: return False
+      return len(hiddevs) >= len(glob.glob(f"{self.path}/functions/hid.*"))
+
+    return True
+
+  # Wait until the gadget is ready(), for up to timeout seconds.
+  # Returns False if it never got there.
+  def wait_ready(self, timeout):
+    return uevent.wait_for(self.ready, timeout)
+
+  # Most recognizable name of the gadget: its interface or device node,
+  # or the configfs path if there is none.
+  def node(self):
+    if self.dev["type"] == "net":
+      node = self.iface
+    elif self.dev["type"] == "serial":
+      node = self.tty
+    elif self.dev["type"] == "hid":
+      node = self.hiddevs[0] if self.hiddevs else None
+    else:
+      node = None
+
+    if node is None:
+      return self.path
+    return node
+
+  def __str__(self):
+    return self.path
+
+
+def _find_udc(conf, dev, path):
+  try:
+    with open(f"{path}/UDC", "r") as f:
+      return f.read().strip() or None
+  except OSError:
+    return None
@@ -1,88 +1,208 @@
-import subprocess
 import select
-import json5
 import os
+import threading
+import time
 
 import status
 
-import heur.hid.util
+#
+# Using the hid_gadget_test program from kernel sources,
+# we can glean this:
+# --caps-lock
+# xmit report: 00 00 39 00 00 00 00 00
+# xmit report: 00 00 00 00 00 00 00 00
+# recv report: 02
+# --caps-lock
+# xmit report: 00 00 39 00 00 00 00 00
+# xmit report: 00 00 00 00 00 00 00 00
+# recv report: 00
+#
+# A host that accepts the keyboard answers a lock key with an LED report.
+# Each key is pressed twice, to leave the host's lock state as it was.
+#
+KEY_CODES = [ 0x53,     # Num lock
+              0x39,     # Caps lock
+              #0x84,     # Scroll lock, doesn't seem to work for this
+            ]
+
+RELEASE_REPORT = bytes([0x00]*8)
+
+# How long to wait for an LED report, in seconds.
+# Learned from how quickly hosts have answered so far. The second press of
+# each key always gets MAX_TIMEOUT.
+MIN_TIMEOUT = 0.1
+MAX_TIMEOUT = 1.0
+
+_LATENCY_LOCK = threading.Lock()
+_latency = None
+
+def _response_timeout():
+  with _LATENCY_LOCK:
+    if _latency is None: return MAX_TIMEOUT
+    return min(MAX_TIMEOUT, max(MIN_TIMEOUT, 4 * _latency))
+
+def _record_latency(latency):
+  global _latency
+  with _LATENCY_LOCK:
+    if _latency is None:
+      _latency = latency
+    else:
+      # Exponentially weighted moving average
+      _latency = 0.75 * _latency + 0.25 * latency
+
 
 class Leds:
-  def init(self, conf, dev, path):
+  def init(self, conf, dev, ctx):
     # This may be multiple nodes.
-    self.devnodes = heur.hid.util.find_hiddev(conf, dev, path)
+    self.devnodes = ctx.hiddevs
+    self.cancelled = threading.Event()
+
+    # Written to by cancel(), to wake up test()
+    self.wakeup = os.eventfd(0, os.EFD_NONBLOCK)
 
 
-  def stim(self, conf, dev, path):
+  def stim(self, conf, dev, ctx):
     pass
 
 
-  def test(self, conf, dev, path):
+  def test(self, conf, dev, ctx):
     if self.devnodes is None: return False
 
-    success = False
-
+    # Probe every node at once
+    fds = {}
     for n in self.devnodes:
       try:
-        fd = os.open(n, flags=os.O_RDWR, mode=0o666)
+        fds[os.open(n, os.O_RDWR | os.O_NONBLOCK)] = n
       except Exception as e:
         status.debug(f"heur.hid.leds: Failed to open {n}: " + str(e))
-        continue
-
-      # Read out whatever report was already in the tube
-      while True:
-        rept = self.try_read_report(fd, 0.1)
-        if rept is None: break
-
-      #
-      # Using the hid_gadget_test program from kernel sources,
-      # we can glean this:
-      # --caps-lock
-      # xmit report: 00 00 39 00 00 00 00 00
-      # xmit report: 00 00 00 00 00 00 00 00
-      # recv report: 02
-      # --caps-lock
-      # xmit report: 00 00 39 00 00 00 00 00
-      # xmit report: 00 00 00 00 00 00 00 00
-      # recv report: 00
-
-      for code in [ 0x53,     # Num lock
-                    0x39,     # Caps lock
-                    #0x84,     # Scroll lock, doesn't seem to work for this
-                  ]:
-
-        # Send a report to toggle that function
+
+    ep = select.epoll()
+    ep.register(self.wakeup, select.EPOLLIN)
+    for fd in fds.keys():
+      ep.register(fd, select.EPOLLIN)
+
+    try:
+      # Whatever report was already in the tube is the LED state to compare against
+      last = { fd: self.drain(fd) for fd in fds.keys() }
+
+      for code in KEY_CODES:
+        # time.monotonic() of the first press of this key which got no answer in time.
+        # An answer to it may still come in during the next one.
+        self.unanswered = None
+
         tx_report = bytes([0x00, 0x00, code, 0x00, 0x00, 0x00, 0x00, 0x00])
 
-        # Send the command once
-        os.write(fd, tx_report)
-        os.write(fd, bytes([0x00]*8))
-        rept_1 = self.try_read_report(fd, 1)
-        status.debug(f"heur.hid.leds: key code {code} once: {rept_1}")
+        for attempt in [ "once", "twice" ]:
+          if self.cancelled.is_set(): return False
 
-        # Send the command twice!
-        os.write(fd, tx_report)
-        os.write(fd, bytes([0x00]*8))
-        rept_2 = self.try_read_report(fd, 1)
-        status.debug(f"heur.hid.leds: key code {code} twice: {rept_2}")
+          # The learned timeout only fits hosts like the ones seen so far.
+          # Give a slower host the full time before writing it off.
+          timeout = MAX_TIMEOUT if attempt == "twice" else None
 
-        if rept_1 != rept_2:
-          success = True
+          changed = self.press(ep, fds, tx_report, last, timeout=timeout)
+          status.debug(f"heur.hid.leds: key code {code} {attempt}: {changed}")
 
-      os.close(fd)
+          if changed is not None:
+            if attempt == "once":
+              # Put the host's lock state back, no need to wait for it
+              self.press(ep, fds, tx_report, last, timeout=0)
+            return True
 
+      return False
 
-    return success
+    finally:
+      ep.close()
+      for fd in fds.keys():
+        os.close(fd)
 
 
-  def cleanup(self, conf, dev, path):
-    pass
+  # test() is no longer needed
+  def cancel(self, conf, dev, ctx):
+    self.cancelled.set()
+    os.eventfd_write(self.wakeup, 1)
 
 
-  def try_read_report(self, fd, timeout):
-    r,_,_ = select.select([fd], [], [], timeout)
+  def cleanup(self, conf, dev, ctx):
+    os.close(self.wakeup)
 
-    if len(r) > 0:
-      return os.read(fd, 1)
-    else:
-      return None
+
+  # Read all pending reports, return the latest one
+  def drain(self, fd):
+    rept = None
+    while True:
+      try:
+        data = os.read(fd, 64)
+      except OSError:
+        # Includes BlockingIOError, once there's nothing left to read
+        return rept
+      if not data: return rept
+      rept = data
+
+
+  # Send a key press and release to all nodes, and wait for any of them to
+  # answer with an LED report which differs from the last one.
+  # Returns the node that answered, or None.
+  def press(self, ep, fds, tx_report, last, timeout=None):
+    if timeout is None:
+      timeout = _response_timeout()
+
+    # Reports still to be written to each node. A node only takes one report
+    # at a time, so the release follows once the press has gone out.
+    outbox = { fd: [ tx_report, RELEASE_REPORT ] for fd in fds.keys() }
+    for fd in fds.keys():
+      ep.modify(fd, select.EPOLLIN | select.EPOLLOUT)
+
+    start = time.monotonic()
+    deadline = start + timeout
+
+    # Give up on nodes which the host doesn't take reports from
+    write_deadline = start + MAX_TIMEOUT
+
+    answered = None
+
+    while not self.cancelled.is_set():
+      now = time.monotonic()
+      sending = any(outbox.values())
+
+      # Don't leave a release report unsent, or the key stays pressed
+      if answered is not None and not sending: break
+      if sending:
+        remaining = write_deadline - now
+      else:
+        remaining = deadline - now
+      if remaining <= 0: break
+
+      for fd,events in ep.poll(remaining):
+        if fd == self.wakeup: continue
+
+        if events & select.EPOLLOUT and outbox[fd]:
+          try:
+            os.write(fd, outbox[fd][0])
+            outbox[fd].pop(0)
+          except BlockingIOError:
+            pass
+          except OSError as e:
+            status.debug(f"heur.hid.leds: Failed to write to {fds[fd]}: " + str(e))
+            outbox[fd] = []
+
+          if not outbox[fd]:
+            ep.modify(fd, select.EPOLLIN)
+
+        if events & select.EPOLLIN:
+          rept = self.drain(fd)
+          if rept is None or rept == last[fd]: continue
+
+          # Late answers count too, and teach the timeout that this host is slower
+          last[fd] = rept
+          if answered is None:
+            pressed = self.unanswered if self.unanswered is not None else start
+            _record_latency(time.monotonic() - pressed)
+            self.unanswered = None
+            answered = fds[fd]
+
+    if answered is None and self.unanswered is None:
+      self.unanswered = start
+
+    for fd in fds.keys():
+      ep.modify(fd, select.EPOLLIN)
+    return answered
@@ -1,44 +1,37 @@
-import subprocess
-import json5
-
 import status
 
+import heur.net.netlink
 import heur.net.util
 
 class IfUp:
-  def init(self, conf, dev, path):
-    self.iface = heur.net.util.find_iface(conf, dev, path)
+  def init(self, conf, dev, ctx):
+    self.iface = ctx.iface
 
     self.was_up = False
 
     if self.iface is None:
-      status.warn(f"net.ifup: Unable to determine interface name for {path}.")
-    else:
-      status.debug(f"net.ifup: Found network interface {self.iface}")
+      status.warn(f"net.ifup: Unable to determine interface name for {ctx.path}.")
+      return
+
+    status.debug(f"net.ifup: Found network interface {self.iface}")
 
     # Do the actual test here, because we need to measure before the
     # global stimulation forces the interface up
+    self.was_up = heur.net.util.is_up(self.iface)
 
-    try:
-      # The ip command can output json! Great!
-      out = subprocess.check_output(["ip", "-json", "link", "show", f"{self.iface}"])
-      stats = json5.loads(out.decode())
-
-      for netdev in stats:
-        if netdev["ifname"] != self.iface: continue
-        self.was_up = "UP" in netdev["flags"]
-    except Exception as e:
-      status.warn("net.ifup: Failed to invoke 'ip'. Test fails. " + str(e))
 
-
-  def stim(self, conf, dev, path):
+  def stim(self, conf, dev, ctx):
     pass
 
-  def test(self, conf, dev, path):
+  # Measured once, in init()
+  def poll(self, conf, dev, ctx):
+    return self.test(conf, dev, ctx)
+
+  def test(self, conf, dev, ctx):
     if self.iface is None: return False
 
     return self.was_up
 
 
-  def cleanup(self, conf, dev, path):
+  def cleanup(self, conf, dev, ctx):
     pass
@@ -1,42 +1,40 @@
-
-import subprocess
-import json5
+import time
 
 import status
 
+import heur.net.netlink
 import heur.net.util
 
 class Link:
-  def init(self, conf, dev, path):
-    self.iface = heur.net.util.find_iface(conf, dev, path)
+  def init(self, conf, dev, ctx):
+    self.iface = ctx.iface
+    self.since = time.monotonic()
 
     if self.iface is None:
-      status.warn(f"net.link: Unable to determine interface name for {path}.")
+      status.warn(f"net.link: Unable to determine interface name for {ctx.path}.")
     else:
       status.debug(f"net.link: Found network interface {self.iface}")
 
+    # Catches carrier that comes and goes between two polls
+    heur.net.netlink.start()
+
 
-  def stim(self, conf, dev, path):
+  def stim(self, conf, dev, ctx):
     pass
 
-  def test(self, conf, dev, path):
+  def poll(self, conf, dev, ctx):
     if self.iface is None: return False
+    if self.test(conf, dev, ctx): return True
+    return None
 
-    link_down = True
-    try:
-      # The ip command can output json! Great!
-      out = subprocess.check_output(["ip", "-json", "link", "show", f"{self.iface}"])
-      stats = json5.loads(out.decode())
-
-      for netdev in stats:
-        if netdev["ifname"] != self.iface: continue
-        link_down = "NO-CARRIER" in netdev["flags"]
+  def test(self, conf, dev, ctx):
+    if self.iface is None: return False
 
-    except Exception as e:
-      status.warn("net.link: Failed to invoke 'ip'. Test fails. " + str(e))
+    if heur.net.netlink.flags_seen_since(self.iface, self.since) & heur.net.netlink.IFF_LOWER_UP:
+      return True
 
-    return not link_down
+    return heur.net.util.has_carrier(self.iface)
 
 
-  def cleanup(self, conf, dev, path):
+  def cleanup(self, conf, dev, ctx):
     pass
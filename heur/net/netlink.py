@@ -0,0 +1,125 @@
+#
+# Listens for link changes on an rtnetlink socket, so that carrier and
+# up/down transitions of the gadget's interface are seen as they happen,
+# even if they don't last until the next time a heuristic looks.
+#
+# One background thread serves every heuristic. If the socket can't be
+# opened, heuristics fall back to reading sysfs when polled.
+#
+
+import collections
+import socket
+import struct
+import threading
+import time
+
+import status
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+
+IFLA_IFNAME = 3
+
+# Interface flags, from linux/if.h
+IFF_UP = 0x1
+IFF_RUNNING = 0x40
+IFF_LOWER_UP = 0x10000
+
+_NLMSGHDR = struct.Struct("=LHHLL")
+_IFINFOMSG = struct.Struct("=BxHiII")
+_RTATTR = struct.Struct("=HH")
+
+_LOCK = threading.Lock()
+_THREAD = None
+
+# Interface name -> deque of (monotonic timestamp, flags)
+_HISTORY = {}
+
+# Called with the interface name on every change
+_LISTENERS = []
+
+
+def add_listener(func):
+  _LISTENERS.append(func)
+
+
+# Start the monitor thread, unless it's already running.
+# Returns False if link changes can't be monitored.
+def start():
+  global _THREAD
+  with _LOCK:
+    if _THREAD is not None:
+      return _THREAD is not False
+
+    try:
+      sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+      sock.bind((0, RTMGRP_LINK))
+    except Exception as e:
+      status.debug("heur.net.netlink: Unable to monitor link changes, falling back to polling: " + str(e))
+      _THREAD = False
+      return False
+
+    _THREAD = threading.Thread(target=_run, args=(sock,), daemon=True)
+    _THREAD.start()
+    return True
+
+
+# Flags of every change to the interface since the given time.monotonic() timestamp, OR-ed together
+def flags_seen_since(iface, since):
+  with _LOCK:
+    history = list(_HISTORY.get(iface, []))
+
+  flags = 0
+  for t,f in history:
+    if t >= since:
+      flags |= f
+  return flags
+
+
+def _parse_ifname(data, offset, end):
+  while offset + _RTATTR.size <= end:
+    length,kind = _RTATTR.unpack_from(data, offset)
+    if length < _RTATTR.size: break
+
+    if kind == IFLA_IFNAME:
+      return data[offset+_RTATTR.size:offset+length].split(b"\0")[0].decode(errors="replace")
+
+    # Attributes are aligned to 4 bytes
+    offset += (length + 3) & ~3
+  return None
+
+
+def _handle(data):
+  offset = 0
+  while offset + _NLMSGHDR.size <= len(data):
+    length,kind,_,_,_ = _NLMSGHDR.unpack_from(data, offset)
+    if length < _NLMSGHDR.size: break
+
+    if kind in [ RTM_NEWLINK, RTM_DELLINK ]:
+      body = offset + _NLMSGHDR.size
+      _,_,_,flags,_ = _IFINFOMSG.unpack_from(data, body)
+      iface = _parse_ifname(data, body + _IFINFOMSG.size, offset + length)
+
+      if iface is not None:
+        if kind == RTM_DELLINK: flags = 0
+
+        with _LOCK:
+          if iface not in _HISTORY:
+            _HISTORY[iface] = collections.deque(maxlen=64)
+          _HISTORY[iface].append((time.monotonic(), flags))
+
+        for func in _LISTENERS:
+          func(iface)
+
+    offset += (length + 3) & ~3
+
+
+def _run(sock):
+  while True:
+    try:
+      _handle(sock.recv(65536))
+    except Exception as e:
+      status.debug("heur.net.netlink: Failed to process link change: " + str(e))
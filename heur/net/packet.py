@@ -0,0 +1,160 @@
+#
+# Raw Ethernet frames: reading pcap files, and sending frames on an interface.
+#
+# Shared by the net stimulation and heuristic modules.
+#
+
+import errno
+import mmap
+import select
+import socket
+import struct
+import threading
+
+import status
+
+ETH_P_ALL = 0x0003
+
+LINKTYPE_ETHERNET = 1
+
+# Magic number of classic pcap files, in microsecond and nanosecond flavors
+_PCAP_MAGIC = { b"\xd4\xc3\xb2\xa1": "<", b"\xa1\xb2\xc3\xd4": ">",
+                b"\x4d\x3c\xb2\xa1": "<", b"\xa1\xb2\x3c\x4d": ">" }
+
+_LOCK = threading.Lock()
+
+# Filename -> Pcap, see load_pcap()
+_PCAPS = {}
+
+
+class Pcap:
+  def __init__(self, filename):
+    self.filename = filename
+
+    with open(filename, "rb") as f:
+      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if len(self.map) < 24 or self.map[0:4] not in _PCAP_MAGIC:
+      raise ValueError(f"{filename} is not a pcap file. pcapng files are not supported, convert them with editcap -F pcap.")
+
+    order = _PCAP_MAGIC[self.map[0:4]]
+    linktype = struct.unpack_from(order + "L", self.map, 20)[0]
+    if linktype != LINKTYPE_ETHERNET:
+      raise ValueError(f"{filename} doesn't contain Ethernet frames (link type {linktype}).")
+
+    # Frames point into the mapped file, they are never copied
+    self.frames = []
+    record = struct.Struct(order + "LLLL")
+    view = memoryview(self.map)
+    offset = 24
+    while offset + record.size <= len(self.map):
+      _,_,captured,_ = record.unpack_from(self.map, offset)
+      offset += record.size
+      if offset + captured > len(self.map):
+        status.warn(f"{filename} is truncated, ignoring its last frame.")
+        break
+      self.frames.append(view[offset:offset+captured])
+      offset += captured
+
+
+# Parse a pcap file, or return the one parsed earlier
+def load_pcap(filename):
+  with _LOCK:
+    if filename not in _PCAPS:
+      _PCAPS[filename] = Pcap(filename)
+    return _PCAPS[filename]
+
+
+# "aa:bb:cc:dd:ee:ff" to bytes
+def mac_bytes(text):
+  return bytes(int(b, 16) for b in text.split(":"))
+
+
+# Raw socket for sending frames on the interface
+def open_socket(iface):
+  sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+  try:
+    sock.bind((iface, 0))
+    sock.setblocking(False)
+  except:
+    sock.close()
+    raise
+  return sock
+
+
+# Send the frames back to back, optionally with their source MAC address replaced.
+# Only waits when the interface's queue is full.
+# Returns the number of frames sent.
+def send_frames(sock, frames, src_mac=None, timeout=1):
+  sent = 0
+
+  for frame in frames:
+    # The new address is sent in place of the old one, without copying the frame
+    if src_mac is not None and len(frame) >= 12:
+      buffers = [ frame[0:6], src_mac, frame[12:] ]
+    else:
+      buffers = [ frame ]
+
+    while True:
+      try:
+        sock.sendmsg(buffers)
+        sent += 1
+        break
+      except (BlockingIOError, InterruptedError):
+        pass
+      except OSError as e:
+        if e.errno != errno.ENOBUFS: raise
+
+      _,w,_ = select.select([], [sock], [], timeout)
+      if not w: return sent
+
+  return sent
+
+
+# The ethertype of a frame, and the offset of its payload, past a VLAN tag if there is one
+def parse_ethernet(frame):
+  ethertype = struct.unpack_from("!H", frame, 12)[0]
+  if ethertype == 0x8100 and len(frame) >= 18:
+    return struct.unpack_from("!H", frame, 16)[0], 18
+  return ethertype, 14
+
+
+# What kind of host traffic a received frame is, or None if it's nothing we know:
+# "dhcp", "dhcpv6", "arp", "mdns", "nd-rs" (router solicitation), "nd-ns" (neighbor
+# solicitation), "nd-na" (neighbor advertisement) or "mld" (multicast listener report).
+def classify(frame):
+  if len(frame) < 14: return None
+
+  kind,payload = parse_ethernet(frame)
+
+  if kind == 0x0806:
+    return "arp"
+
+  if kind == 0x0800 and len(frame) >= payload + 20:
+    ihl = (frame[payload] & 0x0f) * 4
+    proto = frame[payload + 9]
+    if proto == 17 and len(frame) >= payload + ihl + 4:
+      dport = struct.unpack_from("!H", frame, payload + ihl + 2)[0]
+      if dport == 67: return "dhcp"
+      if dport == 5353: return "mdns"
+    return None
+
+  if kind == 0x86dd and len(frame) >= payload + 40:
+    next_header = frame[payload + 6]
+    offset = payload + 40
+
+    # MLD reports come after a hop-by-hop options header
+    if next_header == 0 and len(frame) >= offset + 8:
+      next_header = frame[offset]
+      offset += (frame[offset + 1] + 1) * 8
+
+    if next_header == 58 and len(frame) > offset:
+      return { 133: "nd-rs", 135: "nd-ns", 136: "nd-na", 131: "mld", 143: "mld" }.get(frame[offset])
+
+    if next_header == 17 and len(frame) >= offset + 4:
+      dport = struct.unpack_from("!H", frame, offset + 2)[0]
+      if dport == 547: return "dhcpv6"
+      if dport == 5353: return "mdns"
+    return None
+
+  return None
@@ -1,40 +1,39 @@
-import subprocess
-import json5
-
 import status
 
+import heur.net.netlink
 import heur.net.util
 
+# Byte counts of interfaces which are reused from an earlier test (--reuse-gadget),
+# recorded by heuristics.reset_device(). Only traffic beyond this counts.
+BASELINE = {}
+
 class RX:
-  def init(self, conf, dev, path):
-    self.iface = heur.net.util.find_iface(conf, dev, path)
+  def init(self, conf, dev, ctx):
+    self.iface = ctx.iface
 
     if self.iface is None:
-      status.warn(f"net.rx: Unable to determine interface name for {path}.")
+      status.warn(f"net.rx: Unable to determine interface name for {ctx.path}.")
     else:
       status.debug(f"net.rx: Found network interface {self.iface}")
 
-  def stim(self, conf, dev, path):
-    pass
+    self.baseline = BASELINE.pop(self.iface, 0)
 
-  def test(self, conf, dev, path):
-    if self.iface is None: return False
+    # Traffic usually follows the link coming up, poll again when it does
+    heur.net.netlink.start()
 
-    count = 0
+  def stim(self, conf, dev, ctx):
+    pass
 
-    try:
-      # The ip command can output json! Great!
-      out = subprocess.check_output(["ip", "-stats", "-json", "link", "show", f"{self.iface}"])
-      stats = json5.loads(out.decode())
+  def poll(self, conf, dev, ctx):
+    if self.iface is None: return False
+    if self.test(conf, dev, ctx): return True
+    return None
 
-      for netdev in stats:
-        if netdev["ifname"] != self.iface: continue
-        count = netdev["stats64"]["rx"]["bytes"]
-    except Exception as e:
-      status.warn("net.rx: Failed to invoke 'ip'. Test fails. " + str(e))
+  def test(self, conf, dev, ctx):
+    if self.iface is None: return False
 
-    return count > 0
+    return heur.net.util.rx_bytes(self.iface) > self.baseline
 
 
-  def cleanup(self, conf, dev, path):
+  def cleanup(self, conf, dev, ctx):
     pass
@@ -0,0 +1,109 @@
+#
+# Looks at the frames the host sends to the emulated adapter. A host that
+# accepts the adapter usually starts with DHCP, IPv6 router solicitations
+# and the like, so the first one of those is a strong and early signal.
+#
+# The latest frames received are kept, and saved with a working device.
+#
+
+import collections
+import select
+import socket
+import threading
+import time
+
+import status
+
+import heur.net.packet
+
+# Number of frames kept, and how much of each
+RING_SIZE = 16
+SNAP_LENGTH = 256
+
+# Called with the interface name when the host's first known frame comes in
+_LISTENERS = []
+
+
+def add_listener(func):
+  _LISTENERS.append(func)
+
+
+class Sniff:
+  def init(self, conf, dev, ctx):
+    self.iface = ctx.iface
+    self.sock = None
+    self.thread = None
+    self.stopping = threading.Event()
+
+    # (seconds since the gadget was created, kind, frame)
+    self.frames = collections.deque(maxlen=RING_SIZE)
+    self.first = None
+
+    if self.iface is None:
+      status.warn(f"net.sniff: Unable to determine interface name for {ctx.path}.")
+      return
+
+    try:
+      self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(heur.net.packet.ETH_P_ALL))
+      self.sock.bind((self.iface, 0))
+      self.sock.setblocking(False)
+    except Exception as e:
+      status.warn(f"net.sniff: Unable to capture packets on {self.iface}: " + str(e))
+      if self.sock is not None: self.sock.close()
+      self.sock = None
+      return
+
+    self.thread = threading.Thread(target=self.capture, args=(ctx,), daemon=True)
+    self.thread.start()
+
+  def stim(self, conf, dev, ctx):
+    pass
+
+  def poll(self, conf, dev, ctx):
+    if self.sock is None: return False
+    if self.first is not None: return True
+    return None
+
+  def test(self, conf, dev, ctx):
+    if self.sock is None: return False
+
+    return self.first is not None
+
+
+  def cleanup(self, conf, dev, ctx):
+    self.stopping.set()
+    if self.thread is not None:
+      self.thread.join()
+
+    if self.sock is not None:
+      self.sock.close()
+
+    if len(self.frames) > 0:
+      ctx.evidence["net.sniff"] = [ { "time": round(t, 6), "kind": kind, "frame": frame.hex() }
+                                    for t,kind,frame in self.frames ]
+
+
+  def capture(self, ctx):
+    while not self.stopping.is_set():
+      r,_,_ = select.select([self.sock], [], [], 0.1)
+      if not r: continue
+
+      try:
+        frame,addr = self.sock.recvfrom(65536)
+      except (BlockingIOError, InterruptedError):
+        continue
+      except OSError as e:
+        status.debug(f"net.sniff: Failed to capture on {self.iface}: " + str(e))
+        return
+
+      # Only frames from the host, not the ones we send
+      if addr[2] == socket.PACKET_OUTGOING: continue
+
+      kind = heur.net.packet.classify(frame)
+      self.frames.append((time.monotonic() - ctx.created, kind, frame[:SNAP_LENGTH]))
+
+      if kind is not None and self.first is None:
+        self.first = time.monotonic()
+        status.debug(f"net.sniff: First {kind} frame from the host after {self.first - ctx.created:.3f}s")
+        for func in _LISTENERS:
+          func(self.iface)
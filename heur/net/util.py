@@ -4,14 +4,40 @@
 
 import glob
 
+import heur.net.netlink
+
 def find_iface(conf, dev, path):
   iface = None
 
   # RNDIS and ECM devices list their local interface name in configfs
   for g in glob.glob(f"{path}/functions/*/ifname"):
     try:
-      iface = open(g,"r").read().strip()
+      name = open(g,"r").read().strip()
     except:
-      pass
+      continue
+
+    # Until the gadget is bound, this may be a template like "usb%d"
+    if "%" not in name and "unnamed" not in name:
+      iface = name
 
   return iface
+
+
+def read_sysfs(iface, attr):
+  try:
+    with open(f"/sys/class/net/{iface}/{attr}", "r") as f:
+      return f.read().strip()
+  except OSError:
+    # e.g. reading carrier fails while the interface is down
+    return None
+
+def rx_bytes(iface):
+  value = read_sysfs(iface, "statistics/rx_bytes")
+  return int(value) if value else 0
+
+def is_up(iface):
+  value = read_sysfs(iface, "flags")
+  return value is not None and int(value, 16) & heur.net.netlink.IFF_UP != 0
+
+def has_carrier(iface):
+  return read_sysfs(iface, "carrier") == "1"
@@ -1,45 +1,158 @@
+#
+# A host that accepts a serial device usually opens the port, which shows as a
+# change in the modem control lines (DTR/RTS) or the line coding (baud rate etc.),
+# often long before it sends any data, if it does at all.
+#
+# A watcher thread looks out for both, and for the first byte received.
+#
+# Only some gadget tty drivers pass these on. The stock u_serial tty, used by
+# f_acm and f_serial, implements neither TIOCMGET nor line coding changes, so
+# there the host opening the port can't be seen, and only received data counts.
+# Port settings are only watched on ttys which report their modem control lines.
+#
 
+import fcntl
 import os
+import select
+import struct
+import termios
+import threading
+import time
+import tty
 
 import status
-import heur.serial.util
+
+# How often the port settings are checked for changes
+CHECK_INTERVAL = 0.05
+
+# Called with the tty name when the watcher sees something
+_LISTENERS = []
+
+# Whether we told the user that the tty doesn't show the host opening the port
+_REPORTED_UNSUPPORTED = False
+
+
+def add_listener(func):
+  _LISTENERS.append(func)
+
+
+def _report_unsupported(tty):
+  global _REPORTED_UNSUPPORTED
+  if _REPORTED_UNSUPPORTED: return
+
+  status.info(f"serial.rx: {tty} doesn't report modem control lines or line coding, " +
+              "so only data sent by the host shows that it opened the port.")
+  _REPORTED_UNSUPPORTED = True
 
 
 class RX:
-  def setup(self, conf, dev, path):
-    self.dev = heur.serial.util.find_tty(conf, dev, path)
+  def init(self, conf, dev, ctx):
+    self.dev = ctx.tty
+    self.fd = None
+    self.thread = None
+    self.stopping = threading.Event()
+
+    # time.monotonic() of the first sign of the host opening the port, and of the first byte received
+    self.opened = None
+    self.first_rx = None
+    self.rx_bytes = 0
 
     if self.dev is None:
-      status.warn(f"serial.rx: Unable to determine interface name for {path}.")
-    else:
-      status.debug(f"serial.rx: Found serial interface {self.dev}")
-
-    if self.dev is not None:
-      try:
-        self.fd = open(self.dev, "rb")
-        os.set_blocking(self.fd.fileno(), False)
-      except Exception as e:
-        status.error(f"serial.rx: Failed to open serial port {self.dev} for reading: " + str(e))
-        self.dev = None
-        self.fd = None
-
-  def test(self, conf, dev, path):
-    if self.dev is None: return False
-    if self.fd is None: return False
+      status.warn(f"serial.rx: Unable to determine interface name for {ctx.path}.")
+      return
+
+    status.debug(f"serial.rx: Found serial interface {self.dev}")
 
-    # Non-blocking read!
-    data = self.fd.read()
+    try:
+      self.fd = os.open(self.dev, os.O_RDONLY | os.O_NONBLOCK | os.O_NOCTTY)
 
-    if data is None:
-      return False
+      # Raw mode, so data shows up byte by byte and isn't echoed back to the host
+      tty.setraw(self.fd)
+    except Exception as e:
+      status.error(f"serial.rx: Failed to open serial port {self.dev} for reading: " + str(e))
+      if self.fd is not None: os.close(self.fd)
+      self.dev = None
+      self.fd = None
+      return
 
-    if len(data) > 0:
-      status.debug(f"serial.rx: Received {len(data)} bytes on the serial port!")
+    self.thread = threading.Thread(target=self.watch, args=(ctx,), daemon=True)
+    self.thread.start()
 
-    return len(data) > 0
+  def stim(self, conf, dev, ctx):
+    pass
 
+  def poll(self, conf, dev, ctx):
+    if self.dev is None: return False
+    if self.test(conf, dev, ctx): return True
+    return None
+
+  def test(self, conf, dev, ctx):
+    if self.dev is None: return False
 
+    return self.opened is not None or self.first_rx is not None
+
+
+  def cleanup(self, conf, dev, ctx):
+    self.stopping.set()
+    if self.thread is not None:
+      self.thread.join()
 
-  def cleanup(self, conf, dev, path):
     if self.fd is not None:
-      self.fd.close()
+      os.close(self.fd)
+      self.fd = None
+
+    if self.rx_bytes > 0:
+      status.debug(f"serial.rx: Received {self.rx_bytes} bytes on the serial port!")
+
+
+  def modem_lines(self):
+    try:
+      return struct.unpack("i", fcntl.ioctl(self.fd, termios.TIOCMGET, struct.pack("i", 0)))[0]
+    except OSError:
+      # Not every gadget serial driver reports these
+      return None
+
+  def watch(self, ctx):
+    lines = self.modem_lines()
+    coding = termios.tcgetattr(self.fd)
+
+    # Drivers without TIOCMGET, like u_serial, don't pass on the line coding either.
+    # Don't keep asking them.
+    watch_settings = lines is not None
+    if not watch_settings:
+      _report_unsupported(self.dev)
+
+    while not self.stopping.is_set():
+      r,_,_ = select.select([self.fd], [], [], CHECK_INTERVAL)
+
+      event = None
+      if r:
+        try:
+          data = os.read(self.fd, 4096)
+        except (BlockingIOError, InterruptedError):
+          data = b""
+        except OSError as e:
+          status.debug(f"serial.rx: Failed to read from {self.dev}: " + str(e))
+          return
+
+        if not data:
+          # Hung up, don't spin on it
+          time.sleep(CHECK_INTERVAL)
+        elif self.first_rx is None:
+          self.first_rx = time.monotonic()
+          event = "sent data"
+        self.rx_bytes += len(data)
+
+      if watch_settings and self.opened is None and event is None:
+        if self.modem_lines() != lines:
+          event = "changed the modem control lines"
+        elif termios.tcgetattr(self.fd) != coding:
+          event = "changed the line coding"
+
+        if event is not None:
+          self.opened = time.monotonic()
+
+      if event is not None:
+        status.debug(f"serial.rx: Host {event} on {self.dev} after {time.monotonic() - ctx.created:.3f}s")
+        for func in _LISTENERS:
+          func(self.dev)
@@ -7,6 +7,19 @@ import os
 
 import status
 
+# ACM and generic serial functions report which /dev/ttyGS* they got.
+# This matters when several gadgets are up at once (--parallel).
+# Returns None if the gadget has no such function, or its node doesn't exist yet.
+def find_configfs_tty(path):
+  for f in glob.glob(f"{path}/functions/acm.*/port_num") + glob.glob(f"{path}/functions/gser.*/port_num"):
+    try:
+      devnode = "/dev/ttyGS" + open(f, "r").read().strip()
+      if os.path.exists(devnode):
+        return devnode
+    except Exception as e:
+      status.debug(f"heur.serial: Failed to read {f}: " + str(e))
+  return None
+
 def find_tty(conf, dev, path):
 
   devnode = None
@@ -16,15 +29,20 @@ def find_tty(conf, dev, path):
     if not os.path.exists(devnode):
       status.warn(f"Configured gadget serial device {devnode} does not exist.")
       return None
+    return devnode
+
+  devnode = find_configfs_tty(path)
+  if devnode is not None:
+    return devnode
 
-  # There appears to be no perfectly reliable mapping between our
+  # Otherwise, there appears to be no perfectly reliable mapping between our
   # USB gadget and the device-side serial device.
   # The serial device is always (?) /dev/ttyGS*
 
   devs = glob.glob("/dev/ttyGS*")
 
   if len(devs) == 0:
-    status.warn(f"No suitable serial device found for {dev['name']}. Device spec faulty? Try increasing --setup-duration.")
+    status.warn(f"No suitable serial device found for {dev['name']}. Device spec faulty? Try increasing --setup-timeout.")
     return None
 
   if len(devs) > 1:
@@ -0,0 +1,121 @@
+#
+# Follows /sys/class/udc/<udc>/state, which moves to "configured" once the
+# host has enumerated the device and picked a configuration for it.
+#
+# The kernel notifies pollers of the attribute when the state changes.
+# One watcher thread per UDC records every transition with its time.
+#
+
+import collections
+import os
+import select
+import threading
+import time
+
+import status
+
+CONFIGURED = "configured"
+
+_LOCK = threading.Lock()
+
+# UDC name -> StateWatcher, or None if the state can't be watched
+_WATCHERS = {}
+
+# Called with the UDC name on every change
+_LISTENERS = []
+
+
+def add_listener(func):
+  _LISTENERS.append(func)
+
+
+class StateWatcher:
+  def __init__(self, udc):
+    self.udc = udc
+    self.lock = threading.Lock()
+
+    # (monotonic timestamp, state)
+    self.history = collections.deque(maxlen=64)
+
+    self.fd = os.open(f"/sys/class/udc/{udc}/state", os.O_RDONLY)
+    self.state = self._read()
+    self.history.append((time.monotonic(), self.state))
+
+    threading.Thread(target=self._run, daemon=True).start()
+
+  def _read(self):
+    return os.pread(self.fd, 64, 0).decode(errors="replace").strip()
+
+  def _run(self):
+    poller = select.poll()
+    poller.register(self.fd, select.POLLPRI | select.POLLERR)
+
+    while True:
+      try:
+        # Re-read every second anyway, in case a notification gets lost
+        poller.poll(1000)
+        state = self._read()
+      except Exception as e:
+        status.debug(f"heur.udc.state: Failed to read state of {self.udc}: " + str(e))
+        time.sleep(1)
+        continue
+
+      if state == self.state: continue
+
+      with self.lock:
+        self.state = state
+        self.history.append((time.monotonic(), state))
+      status.debug(f"heur.udc.state: {self.udc} is now {state}")
+
+      for func in _LISTENERS:
+        func(self.udc)
+
+  # Every state seen since the given time.monotonic() timestamp, including the current one
+  def states_since(self, since):
+    with self.lock:
+      states = { s for t,s in self.history if t >= since }
+    states.add(self._read())
+    return states
+
+  def configured_since(self, since):
+    return CONFIGURED in self.states_since(since)
+
+
+# The watcher of the given UDC, started on first use.
+# Returns None if its state is not available.
+def watch(udc):
+  if udc is None: return None
+
+  with _LOCK:
+    if udc not in _WATCHERS:
+      try:
+        _WATCHERS[udc] = StateWatcher(udc)
+      except Exception as e:
+        status.debug(f"heur.udc.state: Unable to watch the state of UDC {udc}: " + str(e))
+        _WATCHERS[udc] = None
+    return _WATCHERS[udc]
+
+
+class State:
+  def init(self, conf, dev, ctx):
+    self.watcher = watch(ctx.udc)
+
+    if self.watcher is None:
+      status.warn(f"udc.state: Unable to determine UDC state for {ctx.path}.")
+
+  def stim(self, conf, dev, ctx):
+    pass
+
+  def poll(self, conf, dev, ctx):
+    if self.watcher is None: return False
+    if self.watcher.configured_since(ctx.created): return True
+    return None
+
+  def test(self, conf, dev, ctx):
+    if self.watcher is None: return False
+
+    return self.watcher.configured_since(ctx.created)
+
+
+  def cleanup(self, conf, dev, ctx):
+    pass
@@ -1,7 +1,11 @@
 
 # These are the heuristics supported, which help determine if a device is accepted by the host.
 # The key is the name of the heuristic,
-# the value is a dict of of { description, device_types=[], handler=class) }
+# the value is a dict of of { description, device_types=[], handler=class, cost, [timeout] }
+#
+# cost is a rough estimate of the time a heuristic takes: 1 for a few reads from
+# sysfs or a device node, more for active tests which wait for the host to respond.
+# Cheaper heuristics are run first, so that expensive ones can often be skipped.
 
 # The class shall expose four methods:
 # - init() will be called right after the device is created
@@ -9,22 +13,47 @@
 # - test() will be called after any user-configured test duration (--test-duration)
 # - cleanup() will be called before the device is torn down
 #
-# All methods will be called with (conf, devspec, gadget_path)
+# All methods will be called with (conf, devspec, ctx), where ctx is the
+# gadget.GadgetContext of the device under test. It knows the gadget's
+# configfs path, and its network interface, tty or hidg nodes.
 #
 # test() should return True if the device is deemed to have been active, i.e. it is
 # recognized and accepted by the target USB host.
+#
+# A class may also expose poll(), which is called repeatedly during the test duration.
+# It should return True as soon as the device is deemed active, False once it can
+# no longer become active, and None while the outcome is still open.
+# Once the overall outcome is decided (see --must-match-all), the test ends early.
+# Heuristics without poll(), or still undecided at the end, get a call to test().
+#
+# test() of several heuristics may run at the same time, in separate threads.
+# If a class also exposes cancel(), it is called from another thread when its
+# test() is no longer needed, or takes longer than the heuristic's "timeout"
+# (in seconds). test() should then return as soon as it can.
+#
+# Anything that learns about a change in the device's state can call notify()
+# to have the heuristics polled right away, instead of at the next --poll-interval.
 
+import concurrent.futures
 import copy
+import os
+import subprocess
+import termios
+import threading
 import time
 import traceback
 
+import gadget
 import status
 
 import heur.hid.leds
 import heur.net.rx
 import heur.net.ifup
 import heur.net.link
+import heur.net.netlink
+import heur.net.sniff
 import heur.serial.rx
+import heur.udc.state
 
 import stimulation
 
@@ -33,51 +62,110 @@ HEURISTICS = {
   "net.rx": {
               "description": "Test if any data is received on the interface. Combine with --net-send-pcap to stimulate the host",
               "device_types": [ "net" ],
-              "handler": heur.net.rx.RX
+              "handler": heur.net.rx.RX,
+              "cost": 1
             },
 
   "net.ifup": {
               "description": "Test if the link is brought up automatically by the host",
               "device_types": [ "net" ],
-              "handler": heur.net.ifup.IfUp
+              "handler": heur.net.ifup.IfUp,
+              "cost": 1
             },
 
   "net.link": {
               "description": "Test if the interface detects a physical link",
               "device_types": [ "net" ],
-              "handler": heur.net.link.Link
+              "handler": heur.net.link.Link,
+              "cost": 1
+            },
+
+  "net.sniff": {
+              "description": "Test if the host sends DHCP, IPv6 neighbor discovery, ARP or mDNS packets on the interface",
+              "device_types": [ "net" ],
+              "handler": heur.net.sniff.Sniff,
+              "cost": 1
             },
 
   "serial.rx": {
-              "description": "Test if any data is received on the serial port.",
+              "description": "Test if the host opens the serial port, as seen from modem control line or line coding changes where the gadget driver reports them (u_serial doesn't), or sends any data on it.",
               "device_types": [ "serial" ],
-              "handler": heur.serial.rx.RX
+              "handler": heur.serial.rx.RX,
+              "cost": 2
             },
 
   "hid.leds": {
               "description": "Test the num lock and caps lock LEDs for responsiveness",
               "device_types": [ "hid" ],
-              "handler": heur.hid.leds.Leds
+              "handler": heur.hid.leds.Leds,
+              "cost": 50,
+              "timeout": 10
+            },
+
+  # Hosts configure most devices, whether or not they have a use for them,
+  # so this one is only applied when asked for by name.
+  "udc.state": {
+              "description": "Test if the host configured the device, according to the UDC. Not included in \"all\"",
+              "device_types": [ "net", "serial", "hid" ],
+              "handler": heur.udc.state.State,
+              "cost": 0,
+              "explicit": True,
+              "gated": False
             },
 }
 
+# Time a heuristic's test() may take, unless it sets its own "timeout"
+DEFAULT_TIMEOUT = 5
+
+# How often _measure() checks for heuristics which have started since,
+# and how long cancelled heuristics get to return from test()
+START_INTERVAL = 0.05
+CANCEL_TIMEOUT = 2
+
+# Wakes up test_device() to poll heuristics, see notify()
+_WAKEUP = threading.Condition()
+
+def notify():
+  with _WAKEUP:
+    _WAKEUP.notify_all()
+
+heur.net.netlink.add_listener(lambda iface: notify())
+heur.udc.state.add_listener(lambda udc: notify())
+heur.serial.rx.add_listener(lambda tty: notify())
+heur.net.sniff.add_listener(lambda iface: notify())
+
 def list_heuristics(conf):
   return copy.deepcopy(HEURISTICS)
 
 
-def user_friendly_device(conf, dev, path):
-  devpath = None
+# A reused gadget keeps its kernel devices from the previous test.
+# Put them back in the state of a freshly created device,
+# so that heuristics measure the new device and not the old one.
+# This is called while the gadget is detached from the host.
+def reset_device(conf, dev, path):
+  ctx = gadget.GadgetContext(conf, dev, path)
+
   if dev["type"] == "net":
-    devpath = heur.net.util.find_iface(conf, dev, path)
+    iface = ctx.iface
+    if iface is None: return
+    try:
+      subprocess.run(["ip", "link", "set", iface, "down"],
+                     stdout=subprocess.PIPE,
+                     stderr=subprocess.STDOUT)
+    except Exception as e:
+      status.warn(f"Unable to bring down reused interface {iface}: " + str(e))
+
+    heur.net.rx.BASELINE[iface] = heur.net.util.rx_bytes(iface)
+
   elif dev["type"] == "serial":
-    devpath = heur.serial.util.find_tty(conf, dev, path)
-  elif dev["type"] == "hid":
-    devpath = heur.hid.util.find_hiddev(conf, dev, path)
-    if type(devpath) == list:
-      devpath = devpath[0]
-  if devpath is None:
-    return path
-  return devpath
+    tty = ctx.tty
+    if tty is None: return
+    try:
+      fd = os.open(tty, os.O_RDWR | os.O_NONBLOCK | os.O_NOCTTY)
+      termios.tcflush(fd, termios.TCIOFLUSH)
+      os.close(fd)
+    except Exception as e:
+      status.warn(f"Unable to flush reused serial port {tty}: " + str(e))
 
 def expand_heuristics_list(conf, pattern_list):
   if pattern_list is None:
@@ -90,24 +178,35 @@ def expand_heuristics_list(conf, pattern_list):
 
   all_heuristics = [ n for n,v in HEURISTICS.items() ]
 
+  # Only allow the ones we actually know.
+  named = list(set(pattern_list) & set(all_heuristics))
+
   if "all" in pattern_list:
-    return all_heuristics
+    return [ n for n in all_heuristics if not HEURISTICS[n].get("explicit") or n in named ]
   else:
-    # Only allow the ones we actually know.
-    return list(set(pattern_list) & set(all_heuristics))
+    return named
 
 # Provide a loaded and active gadget
 # returns True heuristic tests indicate an active device
 # returns False if the device appears inactive
-# This is controlled by --and
-def test_device(conf, dev, path):
+# This is controlled by --must-match-all
+#
+# The time spent in each heuristic is recorded in ctx.durations, and in each phase of the test in ctx.phases.
+def test_device(conf, dev, ctx):
+
+  # Wait for the kernel to create the device nodes, rather than racing it
+  start = time.monotonic()
+  if not ctx.wait_ready(conf.setup_timeout):
+    status.debug(f"Device nodes of {dev['name']} did not appear within --setup-timeout")
+  ctx.add_phase("setup_wait", time.monotonic() - start)
 
-  time.sleep(conf.setup_duration)
+  if conf.setup_duration > 0:
+    time.sleep(conf.setup_duration)
 
-  tests = {}
-  for name, spec in HEURISTICS.items():
-    if dev["type"] in spec["device_types"]:
-      tests[name] = spec["handler"]()
+  # The heuristics selected with --heuristics, cheapest first
+  selected = [ name for name in (conf.heuristics or []) if dev["type"] in HEURISTICS[name]["device_types"] ]
+  selected.sort(key=lambda name: HEURISTICS[name]["cost"])
+  tests = { name: HEURISTICS[name]["handler"]() for name in selected }
 
   if len(tests) == 0:
     status.warn(f"No tests relevant for device {dev['name']} of type {dev['type']}.")
@@ -116,45 +215,221 @@ def test_device(conf, dev, path):
   if len(tests) > 1:
     status.info(f"{len(tests)} tests relevant for this device: {list(tests.keys())}")
 
-  for name,obj in tests.items():
-    try:
-      obj.init(conf, dev, path)
-    except Exception as e:
-      status.error(f"Failed to set up heuristic {name}: " + str(e))
+  results = {}
+
+  # Until the host configures the device, most heuristics have nothing to see.
+  # The UDC state tells us when that happens, see --no-udc-gate.
+  # The GadgetSlot has been watching it since before the gadget was attached.
+  # A device the host doesn't configure within --test-duration fails those
+  # heuristics without running them or stimulating the host.
+  if not conf.no_udc_gate:
+    start = time.monotonic()
+    configured = _wait_configured(conf, ctx, heur.udc.state.watch(ctx.udc))
+    ctx.add_phase("configure_wait", time.monotonic() - start)
 
-  # Send traffic or otherwise futz around with the new interface
-  # Maybe we can make the host advertise itself!
-  stimulation.stimulate_device(conf, dev, path)
+    if not configured:
+      gated = sorted(name for name in tests.keys() if HEURISTICS[name].get("gated", True))
+      _report_unconfigured(dev, gated)
+      for name in gated:
+        results[name] = False
 
-  for name,obj in tests.items():
-    try:
-      obj.stim(conf, dev, path)
-    except Exception as e:
-      status.error(f"Failed to run stim() of heuristic {name}: " + str(e))
+  # The heuristics which get to run
+  active = { name: obj for name,obj in tests.items() if name not in results }
+  pollable = { name: obj for name,obj in active.items() if hasattr(obj, "poll") }
+
+  def poll_all():
+    for name,obj in pollable.items():
+      if _outcome(conf, results, len(tests)) is not None: return
+      if name in results: continue
+
+      passed = _call(conf, dev, ctx, name, obj, "poll", default=False)
+      if passed is not None:
+        results[name] = passed
+
+  for name,obj in active.items():
+    _call(conf, dev, ctx, name, obj, "init")
+
+  # Some heuristics measure in init(), or see the host's reaction right away.
+  # If they already decide the test, there's no need to stimulate the host.
+  poll_all()
+
+  if _outcome(conf, results, len(tests)) is None:
+    # Send traffic or otherwise futz around with the new interface
+    # Maybe we can make the host advertise itself!
+    start = time.monotonic()
+    stimulation.stimulate_device(conf, dev, ctx)
+    ctx.add_phase("stimulation", time.monotonic() - start)
+
+    for name,obj in active.items():
+      if name in results: continue
+      _call(conf, dev, ctx, name, obj, "stim")
+
+  # Poll the heuristics which support it, until the outcome is known
+  # or the test duration runs out.
+  start = time.monotonic()
+  deadline = start + conf.test_duration
+
+  while _outcome(conf, results, len(tests)) is None:
+    poll_all()
+    if _outcome(conf, results, len(tests)) is not None: break
+
+    remaining = deadline - time.monotonic()
+    if remaining <= 0: break
+
+    with _WAKEUP:
+      _WAKEUP.wait(min(conf.poll_interval, remaining))
+
+  # How long the host took to show itself, or --test-duration if it didn't
+  ctx.add_phase("poll_wait", time.monotonic() - start)
+
+  if _outcome(conf, results, len(tests)) is not None:
+    status.debug(f"Test of {dev['name']} decided early by {list(results.keys())}")
+
+  # Measure whatever is still undecided
+  undecided = { name: obj for name,obj in active.items() if name not in results }
+  running = set()
+  if _outcome(conf, results, len(tests)) is None and len(undecided) > 0:
+    running = _measure(conf, dev, ctx, undecided, results, len(tests))
+
+  for name,obj in active.items():
+    # Cleaning up under a test() that is still running would pull its resources away
+    if name in running:
+      status.warn(f"Heuristic {name} is still running, skipping its cleanup.")
+      continue
+    _call(conf, dev, ctx, name, obj, "cleanup")
+
+  start = time.monotonic()
+  stimulation.cleanup_device(conf, dev, ctx)
+  ctx.add_phase("stimulation", time.monotonic() - start)
+
+  status.debug(f"Time spent in heuristics for {dev['name']}: " +
+               ", ".join(f"{name} {ctx.durations.get(name, 0):.3f}s" for name in active.keys()))
+
+  outcome = _outcome(conf, results, len(tests))
+  return bool(outcome)
+
+
+# Wait until the host configures the device, or --test-duration runs out.
+# Returns True if it did, or if the UDC state isn't available.
+def _wait_configured(conf, ctx, gate):
+  if gate is None: return True
+
+  deadline = time.monotonic() + conf.test_duration
+  while not gate.configured_since(ctx.created):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0: return False
+
+    with _WAKEUP:
+      _WAKEUP.wait(min(conf.poll_interval, remaining))
+
+  return True
 
-  time.sleep(conf.test_duration)
-
-  results = []
-  for name,obj in tests.items():
-    passed = False
-    try:
-      passed = obj.test(conf, dev, path)
-    except Exception as e:
-      status.error(f"Failed to measure heuristic {name}: " + str(e))
-      if conf.debug: traceback.format_exc()
-
-    results.append(passed)
-
-  for name,obj in tests.items():
-    try:
-      obj.cleanup(conf, dev, path)
-    except Exception as e:
-      status.error(f"Failed to clean up after heuristic {name}: " + str(e))
 
+# Whether the user has been told about devices failing the UDC gate
+_GATE_REPORTED = False
 
+# Most devices of a scan may fail the gate, so only the first one is a warning
+def _report_unconfigured(dev, gated):
+  global _GATE_REPORTED
+  msg = f"Host never configured {dev['name']}, failing heuristics {gated} without running them."
+  if _GATE_REPORTED:
+    status.debug(msg)
+  else:
+    status.warn(msg + " Further devices like this are only reported with --debug. See --no-udc-gate.")
+    _GATE_REPORTED = True
+
+
+# Run test() of the given heuristics concurrently, on up to --heuristic-workers threads,
+# until the outcome is known. Each heuristic gets up to its "timeout" to finish, from when it starts.
+# Heuristics which are still running when they are no longer needed get a call to cancel(),
+# and up to CANCEL_TIMEOUT to return. Those without cancel() aren't waited for.
+# Returns the names of the heuristics whose test() is still running after that.
+def _measure(conf, dev, ctx, tests, results, count):
+  started = {}
+
+  def run(name, obj):
+    started[name] = time.monotonic()
+    return bool(_call(conf, dev, ctx, name, obj, "test", default=False))
+
+  pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, conf.heuristic_workers))
+  futures = { pool.submit(run, name, obj): name for name,obj in tests.items() }
+  pending = set(futures.keys())
+  cancelled = set()
+
+  try:
+    while len(pending) > 0 and _outcome(conf, results, count) is None:
+      # Wait until the next heuristic finishes, or the first running one times out.
+      # Heuristics which haven't started yet get their deadline once they do, so look again soon.
+      now = time.monotonic()
+      deadlines = [ started[futures[f]] + HEURISTICS[futures[f]].get("timeout", DEFAULT_TIMEOUT)
+                    for f in pending if futures[f] in started ]
+      timeout = max(0, min(deadlines) - now) if deadlines else DEFAULT_TIMEOUT
+      if len(deadlines) < len(pending):
+        timeout = min(timeout, START_INTERVAL)
+
+      done,pending = concurrent.futures.wait(pending, timeout=timeout,
+                                             return_when=concurrent.futures.FIRST_COMPLETED)
+      for f in done:
+        results[futures[f]] = f.result()
+
+      now = time.monotonic()
+      for f in list(pending):
+        name = futures[f]
+        if name in started and now - started[name] >= HEURISTICS[name].get("timeout", DEFAULT_TIMEOUT):
+          status.warn(f"Heuristic {name} timed out, counting it as failed.")
+          results[name] = False
+          pending.remove(f)
+          cancelled.add(f)
+          _cancel(conf, dev, ctx, name, tests[name])
+
+  finally:
+    # The outcome is known, the rest are no longer needed
+    for f in pending:
+      if not f.cancel() and not f.done():
+        cancelled.add(f)
+        _cancel(conf, dev, ctx, futures[f], tests[futures[f]])
+    pool.shutdown(wait=False, cancel_futures=True)
+
+    # Give the ones that can be cancelled a chance to notice, before they get cleaned up.
+    # The others are left to finish on their own.
+    cancellable = { f for f in cancelled if hasattr(tests[futures[f]], "cancel") }
+    if len(cancellable) > 0:
+      concurrent.futures.wait(cancellable, timeout=CANCEL_TIMEOUT)
+
+  return { futures[f] for f in cancelled if not f.done() }
+
+
+def _cancel(conf, dev, ctx, name, obj):
+  if hasattr(obj, "cancel"):
+    _call(conf, dev, ctx, name, obj, "cancel")
+
+
+# Call one of the methods of a heuristic, and add the time it took to ctx.durations,
+# and to ctx.phases as "<name>.<method>".
+# Returns default if the method fails.
+def _call(conf, dev, ctx, name, obj, method, default=None):
+  start = time.monotonic()
+  try:
+    return getattr(obj, method)(conf, dev, ctx)
+  except Exception as e:
+    status.error(f"Heuristic {name} failed in {method}(): " + str(e))
+    if conf.debug: status.debug(traceback.format_exc())
+    return default
+  finally:
+    # Abandoned tests may still get here after the device is done, see _measure()
+    elapsed = time.monotonic() - start
+    with ctx.lock:
+      ctx.durations[name] = ctx.durations.get(name, 0) + elapsed
+    ctx.add_phase(f"{name}.{method}", elapsed)
+
+
+# Overall result of a test, given the heuristics decided so far.
+# Returns None if the remaining heuristics could still change it.
+def _outcome(conf, results, count):
   if conf.must_match_all:
-    return all(results)
+    if False in results.values(): return False
+    if len(results) == count: return True
   else:
-    return any(results)
-
-
+    if True in results.values(): return True
+    if len(results) == count: return False
+  return None
@@ -2,6 +2,7 @@ import time
 import random
 
 import status
+from devicespec import count_devices, iter_devices
 
 #
 # Pseudo-operation
@@ -14,7 +15,9 @@ def pretend(conf, devices):
 
   if len(conf.devices) == 0:
     status.info("No devices specified. Selecting 20 random devices.")
-    conf.devices = random.sample(devices.keys(), 20)
+    conf.devices = random.sample(list(devices.keys()), 20)
+
+  total = count_devices(conf, conf.devices)
 
 
   # Make sure there's at least one success, one failure and one error
@@ -22,7 +25,7 @@ def pretend(conf, devices):
 
   outcomes = [ "good", "bad", "error" ]
 
-  for i in range(len(outcomes), len(conf.devices)):
+  for i in range(len(outcomes), total):
     outcomes += [ random.choice(
                             [ "error" ]*1 +
                             [ "good", ]*2 +
@@ -31,11 +34,9 @@ def pretend(conf, devices):
 
   random.shuffle(outcomes)
 
-  status.progress(0, len(conf.devices))
+  status.progress(0, total)
 
-  for i in range(len(conf.devices)):
-    name = conf.devices[i]
-    dev = devices[name]
+  for i,name,dev in iter_devices(conf, devices, conf.devices):
     path = f"/sys/config/kernel/usb_gadget/macdongler_{i}"
 
     status.testing_device(conf, dev)
@@ -56,7 +57,16 @@ def pretend(conf, devices):
       status.info(f"Checked device {name}, was not accepted by the host")
 
 
-    status.progress(i+1, len(conf.devices))
-
+    status.phases(conf, dev,
+        {
+          "create_gadget": random.uniform(0.1, 0.5),
+          "setup_wait": random.uniform(0.2, 2),
+          "stimulation": random.uniform(0, 0.2),
+          "net.rx.init": random.uniform(0, 0.01),
+          "poll_wait": random.uniform(0.5, 5),
+          "delete_gadget": random.uniform(0.1, 0.5),
+        })
 
+    status.progress(i+1, total)
 
+  status.summary()
@@ -0,0 +1,291 @@
+#
+# A tiny DHCPv4 server and IPv6 router, enabled with --net-respond.
+#
+# Answers the host's DHCP discover/request, IPv6 router and neighbor
+# solicitations and ARP requests on the emulated adapter, straight from a
+# raw socket. A host that accepts the adapter then configures it and keeps
+# talking to it, instead of going quiet after its first attempts.
+#
+# Nothing is configured on our side of the interface. Neither do we offer
+# ourselves as the host's default gateway, so its routing stays as it was.
+#
+# To try it out on a veth pair:
+#   ip link add mdr0 type veth peer name mdr1
+#   ip link set mdr0 up
+#   python3 responder.py mdr0 &
+#   dhclient -v mdr1      # or: ip link set mdr1 up, and look at "ip -6 addr show mdr1"
+#
+
+import ipaddress
+import select
+import socket
+import struct
+import sys
+import threading
+
+import status
+
+import heur.net.packet
+import heur.net.util
+
+# What we hand out over DHCP, and advertise as IPv6 router. Each UDC gets
+# its own /24 and /64 out of these, so that adapters tested in parallel on
+# the same host don't collide. We are .1 in the /24, the host is .2.
+NETWORKS = ipaddress.IPv4Network("10.231.0.0/16")
+PREFIXES = ipaddress.IPv6Network("fd6d:6163:646f::/48")
+LEASE_TIME = 3600
+
+# A router lifetime of 0 hands out the prefix without becoming the default router
+ROUTER_LIFETIME = 0
+
+BROADCAST_MAC = b"\xff" * 6
+ALL_NODES_MAC = b"\x33\x33\x00\x00\x00\x01"
+ALL_NODES_IP = ipaddress.IPv6Address("ff02::1")
+
+DHCP_MAGIC = b"\x63\x82\x53\x63"
+DHCP_DISCOVER, DHCP_OFFER, DHCP_REQUEST, DHCP_ACK, DHCP_NAK = 1, 2, 3, 5, 6
+
+
+def _checksum(data):
+  if len(data) % 2: data += b"\0"
+  total = sum(struct.unpack(f"!{len(data)//2}H", data))
+  while total >> 16:
+    total = (total & 0xffff) + (total >> 16)
+  return ~total & 0xffff
+
+
+def _link_local(mac):
+  # Modified EUI-64
+  eui = bytes([mac[0] ^ 0x02]) + mac[1:3] + b"\xff\xfe" + mac[3:6]
+  return ipaddress.IPv6Address(b"\xfe\x80" + b"\0"*6 + eui)
+
+
+# Frames are built with the VLAN tag of the frame they answer, if any
+def _ipv4_udp(src_mac, dst_mac, vlan, src_ip, dst_ip, sport, dport, payload):
+  udp = struct.pack("!HHHH", sport, dport, 8 + len(payload), 0) + payload
+  ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(udp), 0, 0, 64, 17, 0,
+                   src_ip.packed, dst_ip.packed)
+  ip = ip[:10] + struct.pack("!H", _checksum(ip)) + ip[12:]
+  return dst_mac + src_mac + vlan + b"\x08\x00" + ip + udp
+
+
+def _ipv6_icmp(src_mac, dst_mac, vlan, src_ip, dst_ip, icmp):
+  pseudo = src_ip.packed + dst_ip.packed + struct.pack("!LxxxB", len(icmp), 58)
+  icmp = icmp[:2] + struct.pack("!H", _checksum(pseudo + icmp)) + icmp[4:]
+  ip = struct.pack("!LHBB16s16s", 0x60000000, len(icmp), 58, 255, src_ip.packed, dst_ip.packed)
+  return dst_mac + src_mac + vlan + b"\x86\xdd" + ip + icmp
+
+
+class Responder:
+  # index picks the networks, see NETWORKS and PREFIXES
+  def __init__(self, iface, mac, index=0):
+    self.iface = iface
+    self.mac = mac
+    self.ip6 = _link_local(mac)
+
+    network = ipaddress.IPv4Network((int(NETWORKS.network_address) + (index % 256) * 256, 24))
+    self.server_ip = network.network_address + 1
+    self.client_ip = network.network_address + 2
+    self.netmask = network.netmask
+    self.prefix = ipaddress.IPv6Network((int(PREFIXES.network_address) + ((index % 65536) << 64), 64))
+
+    # Number of answers sent, by kind
+    self.answers = {}
+
+    self.stopping = threading.Event()
+    self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(heur.net.packet.ETH_P_ALL))
+    try:
+      self.sock.bind((iface, 0))
+      self.sock.setblocking(False)
+    except:
+      self.sock.close()
+      raise
+
+    self.thread = threading.Thread(target=self.run, daemon=True)
+
+  def start(self):
+    # Hosts that solicited a router before we were listening get to hear about us anyway
+    self.send("ra", self.router_advertisement(ALL_NODES_MAC, b"", ALL_NODES_IP))
+    self.thread.start()
+
+  # Returns a summary of the answers sent
+  def stop(self):
+    self.stopping.set()
+    if self.thread.is_alive():
+      self.thread.join()
+    self.sock.close()
+    return f"Responder on {self.iface} sent {self.answers}"
+
+  def send(self, kind, frame):
+    try:
+      self.sock.send(frame)
+      self.answers[kind] = self.answers.get(kind, 0) + 1
+    except OSError as e:
+      status.debug(f"responder: Failed to send {kind} on {self.iface}: " + str(e))
+
+  def run(self):
+    while not self.stopping.is_set():
+      r,_,_ = select.select([self.sock], [], [], 0.1)
+      if not r: continue
+
+      try:
+        frame,addr = self.sock.recvfrom(65536)
+      except (BlockingIOError, InterruptedError):
+        continue
+      except OSError as e:
+        status.debug(f"responder: Failed to receive on {self.iface}: " + str(e))
+        return
+
+      if addr[2] == socket.PACKET_OUTGOING: continue
+
+      try:
+        self.handle(frame)
+      except (struct.error, IndexError, ValueError) as e:
+        status.debug(f"responder: Ignoring malformed frame on {self.iface}: " + str(e))
+
+  def handle(self, frame):
+    kind = heur.net.packet.classify(frame)
+    if kind is None: return
+
+    # Answers go out on the same VLAN
+    _,l3 = heur.net.packet.parse_ethernet(frame)
+    vlan = frame[12:l3-2]
+
+    if kind == "dhcp":
+      self.handle_dhcp(frame, vlan, l3)
+    elif kind == "nd-rs":
+      src_mac = frame[6:12]
+      src_ip = ipaddress.IPv6Address(frame[l3+8:l3+24])
+      # Solicitations from hosts without an address yet are answered to everyone
+      if src_ip.is_unspecified:
+        self.send("ra", self.router_advertisement(ALL_NODES_MAC, vlan, ALL_NODES_IP))
+      else:
+        self.send("ra", self.router_advertisement(src_mac, vlan, src_ip))
+    elif kind == "nd-ns":
+      self.handle_neighbor_solicitation(frame, vlan, l3)
+    elif kind == "arp":
+      self.handle_arp(frame, vlan, l3)
+
+  def handle_dhcp(self, frame, vlan, l3):
+    ihl = (frame[l3] & 0x0f) * 4
+    bootp = frame[l3 + ihl + 8:]
+    if len(bootp) < 240 or bootp[0] != 1 or bootp[236:240] != DHCP_MAGIC: return
+
+    xid = bootp[4:8]
+    flags = bootp[10:12]
+    ciaddr = bootp[12:16]
+    chaddr = bootp[28:34]
+
+    # Options are type, length, value
+    options = {}
+    i = 240
+    while i < len(bootp) and bootp[i] != 255:
+      if bootp[i] == 0:
+        i += 1
+        continue
+      options[bootp[i]] = bootp[i+2:i+2+bootp[i+1]]
+      i += 2 + bootp[i+1]
+
+    msg_type = options.get(53, b"\0")[0]
+    if msg_type == DHCP_DISCOVER:
+      reply_type = DHCP_OFFER
+    elif msg_type == DHCP_REQUEST:
+      # The host picked another server's offer
+      if 54 in options and options[54] != self.server_ip.packed: return
+
+      # Or wants an address we don't hand out, e.g. one from an earlier test
+      requested = options.get(50, ciaddr)
+      if requested not in [ self.client_ip.packed, b"\0"*4 ]:
+        reply_type = DHCP_NAK
+      else:
+        reply_type = DHCP_ACK
+    else:
+      return
+
+    if reply_type == DHCP_NAK:
+      yiaddr = b"\0"*4
+      options = bytes([54, 4]) + self.server_ip.packed
+    else:
+      yiaddr = self.client_ip.packed
+      options = (bytes([54, 4]) + self.server_ip.packed +
+                 bytes([51, 4]) + struct.pack("!L", LEASE_TIME) +
+                 bytes([1, 4]) + self.netmask.packed)
+
+    reply = (struct.pack("!BBBB", 2, 1, 6, 0) + xid + b"\0\0" + flags +
+             b"\0"*4 + yiaddr + self.server_ip.packed + b"\0"*4 +
+             chaddr + b"\0"*10 + b"\0"*192 + DHCP_MAGIC +
+             bytes([53, 1, reply_type]) + options +
+             bytes([255]))
+
+    # Clients asking for a broadcast reply can't receive unicast yet, and NAKs are always broadcast
+    if flags[0] & 0x80 or reply_type == DHCP_NAK:
+      dst_mac, dst_ip = BROADCAST_MAC, ipaddress.IPv4Address("255.255.255.255")
+    else:
+      dst_mac, dst_ip = chaddr, self.client_ip
+
+    self.send("dhcp", _ipv4_udp(self.mac, dst_mac, vlan, self.server_ip, dst_ip, 67, 68, reply))
+
+  def router_advertisement(self, dst_mac, vlan, dst_ip):
+    icmp = (struct.pack("!BBHBBHLL", 134, 0, 0, 64, 0, ROUTER_LIFETIME, 0, 0) +
+            # Source link-layer address
+            bytes([1, 1]) + self.mac +
+            # Prefix information, on-link and for autoconfiguration
+            struct.pack("!BBBBLLL", 3, 4, self.prefix.prefixlen, 0xc0, 86400, 14400, 0) +
+            self.prefix.network_address.packed)
+    return _ipv6_icmp(self.mac, dst_mac, vlan, self.ip6, dst_ip, icmp)
+
+  def handle_neighbor_solicitation(self, frame, vlan, l3):
+    src_ip = ipaddress.IPv6Address(frame[l3+8:l3+24])
+    target = ipaddress.IPv6Address(frame[l3+40+8:l3+40+24])
+
+    # Only for our own address. Duplicate address detection is none of our business.
+    if target != self.ip6 or src_ip.is_unspecified: return
+
+    icmp = (struct.pack("!BBHL", 136, 0, 0, 0x60000000) + target.packed +
+            # Target link-layer address
+            bytes([2, 1]) + self.mac)
+    self.send("nd-na", _ipv6_icmp(self.mac, frame[6:12], vlan, self.ip6, src_ip, icmp))
+
+  def handle_arp(self, frame, vlan, l3):
+    arp = frame[l3:l3+28]
+    op = struct.unpack_from("!H", arp, 6)[0]
+    if op != 1 or arp[24:28] != self.server_ip.packed: return
+
+    reply = (arp[0:6] + struct.pack("!H", 2) +
+             self.mac + self.server_ip.packed +
+             arp[8:14] + arp[14:18])
+    self.send("arp", frame[6:12] + self.mac + vlan + b"\x08\x06" + reply)
+
+
+# Start answering on the interface. Returns the running Responder, or None.
+# index picks the networks, see NETWORKS and PREFIXES.
+def start(iface, index=0):
+  addr = heur.net.util.read_sysfs(iface, "address")
+  if addr is None:
+    status.warn(f"responder: Unable to determine MAC address of {iface}")
+    return None
+
+  try:
+    responder = Responder(iface, heur.net.packet.mac_bytes(addr), index)
+  except Exception as e:
+    status.warn(f"responder: Unable to listen on {iface}: " + str(e))
+    return None
+
+  responder.start()
+  return responder
+
+
+if __name__ == "__main__":
+  if len(sys.argv) != 2:
+    sys.stderr.write(f"Usage: {sys.argv[0]} <interface>\n")
+    sys.exit(1)
+
+  responder = start(sys.argv[1])
+  if responder is None:
+    sys.exit(1)
+
+  try:
+    responder.thread.join()
+  except KeyboardInterrupt:
+    pass
+  print(responder.stop())
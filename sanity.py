@@ -5,6 +5,9 @@ import subprocess
 import devicespec
 import configfs
 import status
+import stimulation
+
+import heur.net.packet
 
 
 def find_cmd(name):
@@ -38,16 +41,25 @@ def sanity_options(conf):
 
   return True, ""
 
-def sanity_commands(conf):
-  if conf.net_transmit_pcap:
-    if not find_cmd("tcpreplay"):
-      return False, "Could not find 'tcpreplay', but --net-transmit-pcap is specified."
+def sanity_files(conf):
+  # Loading the files here means they're ready for every device
+  for filename in conf.net_transmit_pcap or []:
+    try:
+      heur.net.packet.load_pcap(filename)
+    except Exception as e:
+      return False, f"Unable to load --net-transmit-pcap file {filename}: " + str(e)
+
+  for filename in conf.serial_transmit_file or []:
+    try:
+      stimulation.load_payload(filename)
+    except Exception as e:
+      return False, f"Unable to read --serial-transmit-file file {filename}: " + str(e)
   return True,""
 
 def sanity_udc(conf):
   # In pretend mode, we won't be interacting with the actual USB controller
-  # so no need to require it.
-  if conf.pretend:
+  # so no need to require it. Neither when only listing the plans for --create-device.
+  if conf.pretend or (conf.dry_run and conf.create_device):
     return True, ""
 
   if not os.path.isdir("/sys/class/udc"):
@@ -55,16 +67,20 @@ def sanity_udc(conf):
                   " If this system has no UDC controller in hardware, load the 'dummy_hcd' kernel module.")
 
   _,dirnames,_ = next(os.walk("/sys/class/udc/", followlinks=True))
-  if not conf.udc_controller:
+  udcs = configfs.udc_controllers(conf)
+  if len(udcs) == 0:
     return False, "No --udc-controller specified. This system supports the following: " + str(dirnames)
-  if conf.udc_controller not in dirnames:
-    return False, "Unknown --udc-controller specified. This system supports the following: " + str(dirnames)
+  for udc in udcs:
+    if udc not in dirnames:
+      return False, f"Unknown --udc-controller {udc} specified. This system supports the following: " + str(dirnames)
+  if len(set(udcs)) != len(udcs):
+    return False, "The same UDC controller is listed more than once in --udc-controller."
   return True,""
 
 
 def sanity_configfs(conf):
   # In pretend mode, we won't be setting up any devices, so no need to require configfs
-  if conf.pretend:
+  if conf.pretend or (conf.dry_run and conf.create_device):
     return True, ""
 
   if not conf.configfs:
@@ -98,7 +114,9 @@ def sanity_devices(conf):
   if devices is None:
     return False,msg
 
-  for name,dev in devices.items():
+  # Compacted devices are all built the same way,
+  # so it's enough to check one of each kind.
+  for dev in devices.representatives():
     if "metadata" not in dev:
       return False,f"A device is missing metadata. This is a bug in the device spec loader! Dev object: {str(dev)}"
 
@@ -108,7 +126,7 @@ def sanity_devices(conf):
     src = dev["metadata"]["source"]
 
     if "type" not in dev:
-      return False,f"Device {name} from {src} has no type specified!"
+      return False,f"Device {dev['name']} from {src} has no type specified!"
   return True,""
 
 
@@ -116,7 +134,7 @@ def sanity_devices(conf):
 def passes_sanity_checks(conf):
 
   for func in [ sanity_options,
-                sanity_commands,
+                sanity_files,
                 sanity_udc,
                 sanity_configfs,
                 sanity_devices,
@@ -0,0 +1,150 @@
+#
+# Runs the device tests of --test-multiple-devices,
+# on one or more UDC controllers at once.
+#
+# Each UDC gets a worker with its own GadgetSlot. The workers take devices
+# from a shared queue, so a slow device on one controller doesn't hold up
+# the others. Devices may complete out of order, so the resume counter only
+# advances past devices which are done, along with every device before them.
+#
+
+import threading
+
+import configfs
+import resume
+import status
+
+
+class Scheduler:
+  # jobs is an iterator of (index, name, device spec), see devicespec.iter_devices()
+  # total is the number of devices in the whole test, including ones already done
+  def __init__(self, conf, jobs, total, udcs, on_reuse=None):
+    self.conf = conf
+    self.jobs = jobs
+    self.total = total
+    self.udcs = udcs
+    self.on_reuse = on_reuse
+
+    self.lock = threading.Lock()
+    self.stopping = threading.Event()
+
+    # The first exception raised by a worker, re-raised by run()
+    self.error = None
+
+    # Indices completed beyond conf.resume_from
+    self.done = set()
+    self.completed = conf.resume_from
+
+    # Index of the next device we expect from jobs
+    self.next_index = conf.resume_from
+
+  def _next_job(self):
+    with self.lock:
+      if self.stopping.is_set(): return None
+      job = next(self.jobs, None)
+
+      # Unknown devices are skipped by the job iterator. Count them as done.
+      end = self.total if job is None else job[0]
+      self.done.update(range(self.next_index, end))
+      self.completed += max(0, end - self.next_index)
+      self.next_index = end + 1
+      return job
+
+  # Move the resume counter past every device that is done
+  def _advance(self):
+    while self.conf.resume_from in self.done:
+      self.done.remove(self.conf.resume_from)
+      self.conf.resume_from += 1
+
+  def _complete(self, i, name, dev, ctx, success, on_found):
+    with self.lock:
+      if success:
+        on_found(self.conf, dev, ctx)
+
+      self.completed += 1
+      status.progress(self.completed, self.total)
+
+      # Keep track of where we were, so we can continue later
+      self.done.add(i)
+      self._advance()
+
+      if self.conf.resume_file:
+        resume.save(self.conf, careful=False)
+
+  def _worker(self, udc, test, on_found):
+    slot = configfs.GadgetSlot(self.conf, udc, on_reuse=self.on_reuse)
+
+    try:
+      job = self._next_job()
+      while job is not None and not self.stopping.is_set():
+        i,name,dev = job
+
+        # With --pipeline, the slot builds the next device while this one is tested
+        next_job = None
+        if self.conf.pipeline and not self.conf.one_step:
+          next_job = self._next_job()
+          if next_job is not None:
+            slot.prepare(next_job[2])
+
+        success,ctx = test(self.conf, slot, name, dev)
+        self._complete(i, name, dev, ctx, success, on_found)
+
+        # One-step mode: one device per controller
+        if self.conf.one_step: break
+
+        # Otherwise, take the next device only now, so that an idle controller can get it first
+        if not self.conf.pipeline:
+          next_job = self._next_job()
+
+        job = next_job
+
+    except Exception as e:
+      status.error(f"Testing on UDC {udc} failed: " + str(e))
+      with self.lock:
+        if self.error is None:
+          self.error = e
+      self.stopping.set()
+      raise
+
+    finally:
+      slot.release()
+
+  # test(conf, slot, name, dev) sets up the device in the slot, tests it,
+  # and returns (success, gadget.GadgetContext).
+  # on_found(conf, dev, ctx) is called for each working device, one at a time.
+  #
+  # Returns 10 if there are devices left to test in --one-step mode, 0 otherwise.
+  def run(self, test, on_found):
+    if len(self.udcs) == 1:
+      self._worker(self.udcs[0], test, on_found)
+
+    else:
+      status.info(f"Testing on {len(self.udcs)} UDC controllers in parallel: {self.udcs}")
+
+      workers = [ threading.Thread(target=self._worker, args=(udc, test, on_found), daemon=True)
+                  for udc in self.udcs ]
+      for w in workers:
+        w.start()
+
+      try:
+        for w in workers:
+          # Join with a timeout, so that CTRL+C gets through
+          while w.is_alive():
+            w.join(0.5)
+      except KeyboardInterrupt:
+        status.warn("Interrupted. Waiting for the devices under test to finish...")
+        self.stopping.set()
+        for w in workers:
+          w.join()
+        raise
+
+      # A worker failed, and the others stopped. Fail the whole run, as with a single UDC.
+      if self.error is not None:
+        raise self.error
+
+    with self.lock:
+      self._advance()
+
+    if self.conf.one_step and self.conf.resume_from < self.total:
+      return 10
+    return 0
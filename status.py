@@ -1,6 +1,13 @@
+import atexit
+import collections
+import glob
+import gzip
 import sys
 import os
 import json
+import queue
+import shutil
+import threading
 import time
 
 # Color isn't a vital feature.
@@ -15,6 +22,32 @@ except:
 STATUS_FILE=None
 DO_DEBUG=False
 
+# Writes status file entries in the background, see _StatusWriter
+WRITER=None
+
+# Number of entries waiting to be written before logging blocks
+QUEUE_SIZE=1024
+
+# How often the status file is synced to disk with --status-fsync periodic, in seconds
+FSYNC_INTERVAL=1
+
+# Entries between lines of the status file index, and seconds between snapshots
+INDEX_INTERVAL=256
+SNAPSHOT_INTERVAL=60
+
+# Recent phase durations by phase name, and the times recent devices were done,
+# see phases() and summary()
+PHASE_WINDOW=1000
+PHASE_BUCKETS=[ 0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30 ]
+PHASES={}
+DEVICES_DONE=collections.deque(maxlen=PHASE_WINDOW)
+DEVICE_COUNT=0
+STARTED=time.monotonic()
+
+# The scan state, as of the latest entries. Written to the status file in snapshots.
+STATE={}
+STATE_LOCK=threading.Lock()
+
 def paint(text, color):
   global DO_COLOR
   if DO_COLOR:
@@ -22,16 +55,228 @@ def paint(text, color):
   else:
     return text
 
-# Drop a JSON object to the status file
+# Appends the status file entries to a file handle that stays open, on its own thread.
+# After each batch of entries, the file is flushed, and synced to disk according to
+# the fsync policy:
+# - "none": never
+# - "event": after every batch
+# - "periodic": every FSYNC_INTERVAL seconds, and right away for errors and found devices
+#
+# Every entry gets a sequence number "seq", which continues across runs.
+#
+# The status file is written in segments. Once it grows past segment_size bytes, or
+# gets older than segment_age seconds, it is renamed to <status file>.<N>, or compressed
+# to <status file>.<N>.gz, and a new one is started. The sidecar <status file>.index
+# has a line every INDEX_INTERVAL entries, with the seq, timestamp, segment number N
+# and byte offset of an entry, so readers can skip straight to recent entries.
+# The segment number of the current status file is one more than the last rotated one.
+#
+# Each segment starts with a "snapshot" of the scan state (see STATE), and another one
+# is written every SNAPSHOT_INTERVAL seconds, so readers don't need the whole history.
+class _StatusWriter:
+  def __init__(self, filename, fsync, segment_size=0, segment_age=0, compress=False):
+    self.filename = filename
+    self.fsync = fsync
+    self.segment_size = segment_size
+    self.segment_age = segment_age
+    self.compress = compress
+
+    self.segment = _last_segment(filename) + 1
+    self.seq = _next_seq(filename)
+    self.index = open(filename + ".index", "a")
+    self._open_segment()
+
+    self.last_sync = time.monotonic()
+    self.last_snapshot = time.monotonic()
+
+    # Whether anything was written since the last fsync
+    self.unsynced = False
+    self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  # Blocks while the queue is full
+  def put(self, obj, durable=False):
+    self.queue.put((obj, durable))
+
+  # Write everything queued so far, and stop
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+    for f in [ self.file, self.index ]:
+      try:
+        f.close()
+      except Exception as e:
+        sys.stderr.write(f"Failed to close status file: {e}\n")
+
+  def _open_segment(self):
+    self.file = open(self.filename, "ab")
+    self.offset = self.file.tell()
+    self.opened = time.monotonic()
+
+    # The first entry of each run gets indexed
+    self.unindexed = INDEX_INTERVAL
+
+  def _rotate(self):
+    self.file.close()
+    rotated = f"{self.filename}.{self.segment}"
+    os.replace(self.filename, rotated)
+
+    if self.compress:
+      threading.Thread(target=_compress, args=(rotated,)).start()
 
-def _log_status(kind, obj):
-  if STATUS_FILE is None: return
+    self.segment += 1
+    self._open_segment()
+    self._snapshot()
+
+  def _write(self, obj):
+    if self.offset > 0:
+      if self.segment_size > 0 and self.offset >= self.segment_size or \
+         self.segment_age > 0 and time.monotonic() - self.opened >= self.segment_age:
+        self._rotate()
+
+    obj["seq"] = self.seq
+    self.seq += 1
+
+    if self.unindexed >= INDEX_INTERVAL:
+      self.index.write(json.dumps({ "seq": obj["seq"],
+                                    "timestamp": obj["timestamp"],
+                                    "segment": self.segment,
+                                    "offset": self.offset }) + "\n")
+      self.unindexed = 0
+
+    line = (json.dumps(obj).replace("\n", "").strip() + "\n").encode()
+    self.file.write(line)
+    self.offset += len(line)
+    self.unindexed += 1
+
+  def _snapshot(self):
+    with STATE_LOCK:
+      if len(STATE) == 0: return
+      obj = dict(STATE, kind="snapshot", timestamp=int(time.time()))
+    self._write(obj)
+    self.last_snapshot = time.monotonic()
+
+  def _run(self):
+    running = True
+    while running:
+      try:
+        batch = [ self.queue.get(timeout=FSYNC_INTERVAL) ]
+      except queue.Empty:
+        batch = []
+
+      # Take whatever else is waiting, so it's flushed together
+      while True:
+        try:
+          batch.append(self.queue.get_nowait())
+        except queue.Empty:
+          break
+
+      # A failed write, e.g. with the disk full, only loses that entry.
+      # The rest of the batch, and the stop request, are still handled.
+      written = False
+      durable = False
+      try:
+        for item in batch:
+          if item is None:
+            running = False
+            continue
+          obj,item_durable = item
+          durable = durable or item_durable
+          try:
+            self._write(obj)
+            written = True
+          except Exception as e:
+            sys.stderr.write(f"Failed to write status file: {e}\n")
+
+        if written and time.monotonic() - self.last_snapshot >= SNAPSHOT_INTERVAL:
+          self._snapshot()
+      except Exception as e:
+        sys.stderr.write(f"Failed to write status file: {e}\n")
+      finally:
+        try:
+          self._sync(written, durable or not running)
+        except Exception as e:
+          sys.stderr.write(f"Failed to sync status file: {e}\n")
+
+  def _sync(self, written, durable):
+    if written:
+      self.unsynced = True
+      self.file.flush()
+      self.index.flush()
+
+    if self.fsync == "none" or not self.unsynced: return
+
+    now = time.monotonic()
+    if self.fsync == "event" and written or \
+       self.fsync == "periodic" and (durable or now - self.last_sync >= FSYNC_INTERVAL):
+      os.fsync(self.file.fileno())
+      os.fsync(self.index.fileno())
+      self.last_sync = now
+      self.unsynced = False
+
+
+# Highest N of the rotated <filename>.<N> and <filename>.<N>.gz segments, or 0
+def _last_segment(filename):
+  last = 0
+  for f in glob.glob(glob.escape(filename) + ".*"):
+    n = f[len(filename)+1:].split(".")[0]
+    if n.isdigit():
+      last = max(last, int(n))
+  return last
+
+# The file holding segment N: rotated, compressed, or the current status file
+def _segment_path(filename, n):
+  for path in [ f"{filename}.{n}", f"{filename}.{n}.gz" ]:
+    if os.path.exists(path): return path
+  return filename
+
+# Sequence number of the next entry, following the last run's entries
+def _next_seq(filename):
+  try:
+    with open(filename + ".index", "r") as f:
+      lines = f.readlines()
+    last = json.loads(lines[-1])
+  except Exception:
+    return 0
+
+  # Count the entries from the last indexed one on
+  seq = last["seq"]
+  for n in range(last["segment"], _last_segment(filename) + 2):
+    path = _segment_path(filename, n)
+    try:
+      with (gzip.open if path.endswith(".gz") else open)(path, "rb") as f:
+        if n == last["segment"]:
+          f.seek(last["offset"])
+        seq += sum(1 for _ in f)
+    except OSError:
+      pass
+  return seq
+
+def _compress(filename):
+  try:
+    with open(filename, "rb") as src, gzip.open(filename + ".gz.tmp", "wb") as dst:
+      shutil.copyfileobj(src, dst)
+    os.replace(filename + ".gz.tmp", filename + ".gz")
+    os.remove(filename)
+  except Exception as e:
+    sys.stderr.write(f"Failed to compress status file segment {filename}: {e}\n")
+
+
+# Drop a JSON object to the status file
+# Durable entries (errors, found devices) get synced to disk as soon as possible.
+def _log_status(kind, obj, durable=False):
+  if WRITER is None: return
 
   obj["kind"] = kind
   obj["timestamp"] = int(time.time())
-  j = json.dumps(obj).replace("\n", "").strip()
-  with open(STATUS_FILE, "a+") as f:
-    f.write(j + "\n")
+  WRITER.put(obj, durable)
+
+def _close_status():
+  global WRITER
+  if WRITER is not None:
+    WRITER.close()
+    WRITER = None
 
 def _fallback(obj, key, val):
   if key in obj:
@@ -42,9 +287,17 @@ def setup(conf):
   global STATUS_FILE
   global DO_COLOR
   global DO_DEBUG
+  global WRITER
 
   if conf.status_file is not None:
     STATUS_FILE=conf.status_file
+    WRITER=_StatusWriter(STATUS_FILE, conf.status_fsync,
+                         segment_size=conf.status_segment_size,
+                         segment_age=conf.status_segment_age,
+                         compress=conf.status_compress)
+
+    # Make sure everything is written before the process exits
+    atexit.register(_close_status)
 
   if conf.no_color:
     DO_COLOR=False
@@ -56,13 +309,16 @@ def found_device(conf, dev, path):
   lbl = paint("FOUND", "green")
   msg = f"Device {dev['name']} appears to work!"
   sys.stderr.write(f"{lbl}: {msg}\n")
+  with STATE_LOCK:
+    STATE["found"] = STATE.get("found", 0) + 1
+
   _log_status("found",
       {
         "device_name": dev["name"],
         "device_type": dev["type"],
         "device_vid": dev["properties"]["idVendor"],
         "device_pid": dev["properties"]["idProduct"],
-      })
+      }, durable=True)
 
 def testing_device(conf, dev):
   lbl = paint("TESTING", "blue")
@@ -71,6 +327,9 @@ def testing_device(conf, dev):
 
   vid = _fallback(dev["properties"], "idVendor", 0)
   pid = _fallback(dev["properties"], "idProduct", 0)
+  with STATE_LOCK:
+    STATE["current_device"] = dev["name"]
+
   _log_status("current_device",
       {
         "device_name": dev["name"],
@@ -99,6 +358,9 @@ def progress(current, target):
   msg = f"{round(frac*100):3d}% |{bar}|"
   sys.stderr.write(f"{lbl}: {msg}\n")
 
+  with STATE_LOCK:
+    STATE.update(current=current, target=target, percent=round(frac*100))
+
   _log_status("progress",
       {
         "current": current,
@@ -106,6 +368,84 @@ def progress(current, target):
         "percent": round(frac*100)
       })
 
+# Record the time each phase of a device test took, in seconds:
+# create_gadget, setup_wait, stimulation, <heuristic>.<method>, poll_wait, delete_gadget.
+# Kept for summary(), and written to the status file as one entry per device.
+def phases(conf, dev, durations):
+  global DEVICE_COUNT
+
+  now = time.monotonic()
+  with STATE_LOCK:
+    for name,seconds in durations.items():
+      if name not in PHASES:
+        PHASES[name] = collections.deque(maxlen=PHASE_WINDOW)
+      PHASES[name].append(seconds)
+
+    DEVICE_COUNT += 1
+    DEVICES_DONE.append(now)
+    rate = _devices_per_hour()
+    if rate is not None:
+      STATE["devices_per_hour"] = rate
+
+  _log_status("phases",
+      {
+        "device_name": dev["name"],
+        "phases": { name: round(seconds, 6) for name,seconds in durations.items() },
+      })
+
+# Over the recent devices, or None if there are too few to tell
+def _devices_per_hour():
+  if len(DEVICES_DONE) < 2 or DEVICES_DONE[-1] <= DEVICES_DONE[0]: return None
+  return round((len(DEVICES_DONE) - 1) / (DEVICES_DONE[-1] - DEVICES_DONE[0]) * 3600, 1)
+
+def _percentile(values, fraction):
+  return values[min(len(values) - 1, int(fraction * len(values)))]
+
+# Statistics of the recent durations of a phase
+def _phase_stats(values):
+  values = sorted(values)
+  histogram = { str(bound): 0 for bound in PHASE_BUCKETS + [ "inf" ] }
+  for v in values:
+    bound = next((b for b in PHASE_BUCKETS if v <= b), "inf")
+    histogram[str(bound)] += 1
+
+  return {
+    "count": len(values),
+    "mean": round(sum(values) / len(values), 6),
+    "p50": round(_percentile(values, 0.5), 6),
+    "p90": round(_percentile(values, 0.9), 6),
+    "p99": round(_percentile(values, 0.99), 6),
+    "max": round(values[-1], 6),
+    "histogram": histogram,
+  }
+
+# Where the time went, over the last PHASE_WINDOW devices. Call at the end of a run.
+def summary():
+  if DEVICE_COUNT == 0: return
+
+  with STATE_LOCK:
+    stats = { name: _phase_stats(values) for name,values in PHASES.items() if len(values) > 0 }
+    rate = _devices_per_hour()
+
+  elapsed = time.monotonic() - STARTED
+  if rate is None and elapsed > 0:
+    rate = round(DEVICE_COUNT / elapsed * 3600, 1)
+
+  lbl = "SUMMARY"
+  sys.stderr.write(f"{lbl}: Tested {DEVICE_COUNT} devices in {elapsed:.0f}s, {rate} devices per hour\n")
+  sys.stderr.write(f"{lbl}: {'phase':<24} {'mean':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}\n")
+  for name,st in sorted(stats.items(), key=lambda item: -item[1]["mean"]):
+    sys.stderr.write(f"{lbl}: {name:<24} " +
+                     " ".join(f"{st[k]:8.3f}" for k in [ "mean", "p50", "p90", "p99", "max" ]) + "\n")
+
+  _log_status("summary",
+      {
+        "devices": DEVICE_COUNT,
+        "elapsed": round(elapsed, 3),
+        "devices_per_hour": rate,
+        "phases": stats,
+      }, durable=True)
+
 def error(msg):
   lbl = paint("ERROR", "red")
   sys.stderr.write(f"{lbl}: {msg}\n")
@@ -114,7 +454,7 @@ def error(msg):
       {
         "level": "error",
         "text": msg,
-      })
+      }, durable=True)
 
 def warn(msg):
   lbl = paint("WARNING", "yellow")
@@ -3,18 +3,22 @@
 #
 
 import os
+import select
 import subprocess
+import threading
 
+import configfs
+import responder
 import status
+import heur.net.packet
 import heur.net.util
-import heur.serial.util
 
-def _net_force_up(conf, dev, path):
+def _net_force_up(conf, dev, ctx):
 
-  iface = heur.net.util.find_iface(conf, dev, path)
+  iface = ctx.iface
 
   if iface is None:
-    status.warn(f"stim.net.force_up: Unable to determine interface name of {path}")
+    status.warn(f"stim.net.force_up: Unable to determine interface name of {ctx.path}")
     return
 
   try:
@@ -27,65 +31,164 @@ def _net_force_up(conf, dev, path):
   return
 
 # Triggered by --net-transmit-pcap
-def _net_transmit_pcap(conf, dev, path):
+# The files are parsed once, by the sanity checks at startup.
+def _net_transmit_pcap(conf, dev, ctx):
   if not conf.net_transmit_pcap: return
   if dev["type"] != "net": return
 
-  iface = heur.net.util.find_iface(conf, dev, path)
+  iface = ctx.iface
 
   if iface is None:
-    status.warn(f"stim.net.pcap: Unable to determine interface name of {path}")
+    status.warn(f"stim.net.pcap: Unable to determine interface name of {ctx.path}")
     return
 
-  for filename in conf.net_transmit_pcap:
-    if not os.path.exists(filename):
-      status.warn(f"stim.net.pcap: pcap file not found: {filename}")
-      continue
+  # Make the frames look like they come from this device
+  src_mac = None
+  if conf.net_pcap_rewrite_mac:
+    addr = heur.net.util.read_sysfs(iface, "address")
+    if addr is not None:
+      src_mac = heur.net.packet.mac_bytes(addr)
 
-    try:
-      result = subprocess.run(["tcpreplay", f"--intf1={iface}", filename],
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT)
-      #status.debug("tcpreplay output: " + result.stdout)
-    except Exception as e:
-      status.warn("stim.net.pcap: Failed to invoke tcpreplay: " + str(e))
+  try:
+    sock = heur.net.packet.open_socket(iface)
+  except Exception as e:
+    status.warn(f"stim.net.pcap: Unable to send packets on {iface}: " + str(e))
+    return
 
+  with sock:
+    for filename in conf.net_transmit_pcap:
+      try:
+        pcap = heur.net.packet.load_pcap(filename)
+        sent = heur.net.packet.send_frames(sock, pcap.frames, src_mac)
+        status.debug(f"stim.net.pcap: Sent {sent} of {len(pcap.frames)} packets from {filename}")
+      except Exception as e:
+        status.warn(f"stim.net.pcap: Failed to send {filename}: " + str(e))
 
-def _serial_transmit_file(conf, dev, path):
-  if not conf.serial_transmit_file: return
-  if dev["type"] != "serial": return
 
-  iface = heur.serial.util.find_tty(conf, dev, path)
+# Triggered by --net-respond
+# Keeps answering the host until cleanup_device()
+def _net_respond(conf, dev, ctx):
+  if not conf.net_respond: return
+
+  iface = ctx.iface
 
   if iface is None:
-    status.warn(f"stim.serial.transmit: Unable to determine device name of {path}")
+    status.warn(f"stim.net.respond: Unable to determine interface name of {ctx.path}")
     return
 
-  try:
+  # Each UDC gets its own networks, so that adapters tested in parallel don't collide
+  udcs = configfs.udc_controllers(conf)
+  index = udcs.index(ctx.udc) if ctx.udc in udcs else 0
+
+  r = responder.start(iface, index)
+  if r is not None:
+    ctx.stimulators.append(r)
+
+
+# Files from --serial-transmit-file, by name. See load_payload().
+_PAYLOADS = {}
+
+# Size of each write to the tty, and the pause after it,
+# so that a slow host gets to read along
+SERIAL_CHUNK_SIZE = 256
+SERIAL_CHUNK_INTERVAL = 0.01
+
+# Read a file to send, or return the one read earlier
+def load_payload(filename):
+  if filename not in _PAYLOADS:
+    with open(filename, "rb") as f:
+      _PAYLOADS[filename] = f.read()
+  return _PAYLOADS[filename]
+
+
+# Streams the payloads to the tty in the background, for as long as the test runs.
+# The tty may take only part of a write, or nothing at all while the host isn't reading.
+class SerialWriter:
+  def __init__(self, tty, payloads):
+    self.tty = tty
+    self.payloads = payloads
+    self.written = 0
+    self.stopping = threading.Event()
+
     # Must open non-blocking, because an unconnected tty won't buffer data
-    fd = os.open(iface, os.O_WRONLY | os.O_NONBLOCK)
-  except:
-    status.warn(f"stim.serial.transmit: Failed to open device {iface} for writing")
+    self.fd = os.open(tty, os.O_WRONLY | os.O_NONBLOCK | os.O_NOCTTY)
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def run(self):
+    for payload in self.payloads:
+      data = memoryview(payload)
+      while len(data) > 0:
+        if self.stopping.is_set(): return
+
+        _,w,_ = select.select([], [self.fd], [], 0.1)
+        if not w: continue
+
+        try:
+          count = os.write(self.fd, data[:SERIAL_CHUNK_SIZE])
+        except (BlockingIOError, InterruptedError):
+          continue
+        except OSError as e:
+          status.debug(f"stim.serial.transmit: Failed to write to {self.tty}: " + str(e))
+          return
+
+        self.written += count
+        data = data[count:]
+        self.stopping.wait(SERIAL_CHUNK_INTERVAL)
+
+  # Returns a summary of what was delivered
+  def stop(self):
+    self.stopping.set()
+    self.thread.join()
+    os.close(self.fd)
+    total = sum(len(p) for p in self.payloads)
+    return f"Wrote {self.written} of {total} bytes to {self.tty}"
+
+
+# Triggered by --serial-transmit-file
+# The files are read once, by the sanity checks at startup.
+def _serial_transmit_file(conf, dev, ctx):
+  if not conf.serial_transmit_file: return
+  if dev["type"] != "serial": return
+
+  tty = ctx.tty
+
+  if tty is None:
+    status.warn(f"stim.serial.transmit: Unable to determine device name of {ctx.path}")
     return
 
+  payloads = []
   for filename in conf.serial_transmit_file:
-    if not os.path.exists(filename):
-      status.warn(f"stim.serial.transmit: input file not found: {filename}")
-      continue
+    try:
+      payloads.append(load_payload(filename))
+    except Exception as e:
+      status.warn(f"stim.serial.transmit: Unable to read {filename}: " + str(e))
+
+  try:
+    ctx.stimulators.append(SerialWriter(tty, payloads))
+  except Exception as e:
+    status.warn(f"stim.serial.transmit: Failed to open device {tty} for writing: " + str(e))
 
-    data = open(filename, "rb").read()
-    status.debug(f"stim.serial.transmit: Writing data to serial port (non-blocking)")
-    os.write(fd, data)
-    os.close(fd)
-    status.debug(f"stim.serial.transmit: done")
 
 # Look at the user's configuration and carry out whichever stimulation
 # is appropriate for this device
-def stimulate_device(conf, dev, path):
+def stimulate_device(conf, dev, ctx):
 
   if dev["type"] == "net":
-    _net_force_up(conf, dev, path)
-    _net_transmit_pcap(conf, dev, path)
+    _net_force_up(conf, dev, ctx)
+    _net_respond(conf, dev, ctx)
+    _net_transmit_pcap(conf, dev, ctx)
 
   if dev["type"] == "serial":
-    _serial_transmit_file(conf, dev, path)
+    _serial_transmit_file(conf, dev, ctx)
+
+# Stop whatever stimulation is still running, before the device is torn down.
+# Each one's stop() returns a summary of what it did.
+def cleanup_device(conf, dev, ctx):
+  for stimulator in ctx.stimulators:
+    try:
+      summary = stimulator.stop()
+      status.debug(f"stim: {summary}")
+    except Exception as e:
+      status.warn(f"stim: Failed to stop {type(stimulator).__name__}: " + str(e))
+  ctx.stimulators = []
@@ -0,0 +1,92 @@
+#
+# Waits for the kernel to announce new devices, such as the network
+# interface or tty of a freshly bound gadget.
+#
+# A background thread listens for kernel uevents and wakes up everyone
+# waiting in wait_for(). Without access to the uevent socket, waiters
+# fall back to checking every FALLBACK_INTERVAL seconds.
+#
+
+import socket
+import threading
+import time
+
+import status
+
+NETLINK_KOBJECT_UEVENT = 15
+
+# Kernel uevents, as opposed to the ones re-broadcast by udev
+UEVENT_GROUP_KERNEL = 1
+
+FALLBACK_INTERVAL = 0.05
+
+# Even with uevents, check every now and then, in case a node's
+# appearance isn't announced (e.g. /dev nodes made by udev later on)
+EVENT_INTERVAL = 0.25
+
+_CONDITION = threading.Condition()
+_THREAD = None
+
+
+# Start the listener thread, unless it's already running.
+# Returns False if uevents can't be received.
+def start():
+  global _THREAD
+  with _CONDITION:
+    if _THREAD is not None:
+      return _THREAD is not False
+
+    try:
+      sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+      sock.bind((0, UEVENT_GROUP_KERNEL))
+    except Exception as e:
+      status.debug("uevent: Unable to listen for kernel uevents, falling back to polling: " + str(e))
+      _THREAD = False
+      return False
+
+    _THREAD = threading.Thread(target=_run, args=(sock,), daemon=True)
+    _THREAD.start()
+    return True
+
+
+# Wait until ready() returns True, or the timeout runs out.
+# ready() is checked again after each uevent.
+# Returns the final result of ready().
+def wait_for(ready, timeout):
+  interval = EVENT_INTERVAL if start() else FALLBACK_INTERVAL
+  deadline = time.monotonic() + timeout
+
+  with _CONDITION:
+    while not ready():
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return False
+      _CONDITION.wait(min(interval, remaining))
+
+  return True
+
+
+# A uevent looks like "add@/devices/...\0ACTION=add\0DEVPATH=...\0SUBSYSTEM=net\0..."
+def parse(data):
+  fields = data.split(b"\0")
+  event = {}
+  for f in fields[1:]:
+    key,sep,value = f.partition(b"=")
+    if sep:
+      event[key.decode(errors="replace")] = value.decode(errors="replace")
+  return event
+
+
+def _run(sock):
+  while True:
+    try:
+      event = parse(sock.recv(65536))
+    except Exception as e:
+      status.debug("uevent: Failed to receive uevent: " + str(e))
+      continue
+
+    if event.get("ACTION") not in [ "add", "bind", "change", "move" ]:
+      continue
+
+    with _CONDITION:
+      _CONDITION.notify_all()